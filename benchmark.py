@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks of the game core on the large map from `run.py`
+(searches of the map also on the small and medium ones).
+
+Run from the repository root: `./benchmark.py`. Nothing is kept, the maps
+are generated into temporary directories.
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import queue
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from typing import Any, Callable
+
+from blockly.actions import cowboy_directions
+from blockly.blocks import Run, cowboy_factories
+from blockly.distances import DistanceCache, DistanceTable
+from blockly.map import GameMap, Bullet, Coords
+from blockly.parser import Parser, ParserInstance
+from blockly.team import Team, TeamProgram
+
+
+# Maps from `run.py`: size, cowboys per team, golds, wall fraction, cluster max
+MAPS = {
+    "small": (20, 1, 10, 50, 5),
+    "medium": (40, 4, 20, 50, 5),
+    "large": (50, 10, 50, 2, 500),
+}
+
+
+def make_map(size: int, cowboys_per_team: int, gold_count: int, wall_fraction: int, cluster_max: int) -> GameMap:
+    teams = [Team(f"team{i}", "", load_from_file=False) for i in range(10)]
+    with tempfile.TemporaryDirectory() as save_dir:
+        return GameMap(width=size, height=size, teams=teams,
+                       cowboys_per_team=cowboys_per_team,
+                       gold_count=gold_count,
+                       wall_fraction=wall_fraction, cluster_max=cluster_max,
+                       save_dir=save_dir)
+
+
+def large_map() -> GameMap:
+    return make_map(*MAPS["large"])
+
+
+def instance_size(obj: Any) -> int:
+    """Size of the object itself and its `__dict__` (if any)."""
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+
+def allocated(create: Callable[[], Any]) -> tuple[int, Any]:
+    """Bytes allocated by `create` which stay allocated, and its result."""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = create()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, result
+
+
+def best_time(f: Callable[[], Any], number: int) -> float:
+    """Seconds per call of `f`, best of several repetitions."""
+    return min(timeit.repeat(f, number=number, repeat=7)) / number
+
+
+def report(name: str, value: float, unit: str) -> None:
+    print(f"{name:<48} {value:>12.2f} {unit}")
+
+
+# Program used for parsing and execution benchmarks: walk over all golds
+# and go towards the nearest one.
+SAMPLE_PROGRAM = """<xml xmlns="https://developers.google.com/blockly/xml">
+<variables><variable>i</variable><variable>best</variable><variable>dist</variable></variables>
+<block type="variables_set"><field name="VAR">best</field>
+ <value name="VALUE"><block type="math_number"><field name="NUM">1000</field></block></value>
+ <next><block type="controls_for"><field name="VAR">i</field>
+  <value name="FROM"><block type="math_number"><field name="NUM">0</field></block></value>
+  <value name="TO"><block type="info_gold_count"></block></value>
+  <value name="BY"><block type="math_number"><field name="NUM">1</field></block></value>
+  <statement name="DO"><block type="variables_set"><field name="VAR">dist</field>
+   <value name="VALUE"><block type="count_distance">
+    <value name="POSITION"><block type="info_gold_position">
+     <value name="GOLD"><block type="variables_get"><field name="VAR">i</field></block></value>
+    </block></value>
+   </block></value>
+   <next><block type="controls_if">
+    <value name="IF0"><block type="logic_compare"><field name="OP">LT</field>
+     <value name="A"><block type="variables_get"><field name="VAR">dist</field></block></value>
+     <value name="B"><block type="variables_get"><field name="VAR">best</field></block></value>
+    </block></value>
+    <statement name="DO0"><block type="variables_set"><field name="VAR">best</field>
+     <value name="VALUE"><block type="variables_get"><field name="VAR">dist</field></block></value>
+    </block></statement>
+   </block></next>
+  </block></statement>
+  <next><block type="move_direction_number">
+   <value name="DIRECTION"><block type="math_arithmetic_custom"><field name="OP">MODULO</field>
+    <value name="A"><block type="variables_get"><field name="VAR">best</field></block></value>
+    <value name="B"><block type="math_number"><field name="NUM">8</field></block></value>
+   </block></value>
+  </block></next>
+ </block></next>
+</block>
+</xml>"""
+
+
+def bench_entities(game_map: GameMap) -> None:
+    bullets = [Bullet(i % 10, (i % 50, i // 50), i % 8) for i in range(500)]
+    report("Cowboy instance size", instance_size(game_map.cowboy_list[0]), "B")
+    report("Bullet instance size", instance_size(bullets[0]), "B")
+    report("Gold instance size", instance_size(game_map.gold_list[0]), "B")
+
+    cowboys = game_map.cowboy_list
+    n = 200
+
+    def read_cowboys() -> None:
+        for cowboy in cowboys:
+            cowboy.position
+            cowboy.team
+            cowboy.index
+
+    t = best_time(read_cowboys, n) / (len(cowboys) * 3)
+    report("Cowboy attribute read", t * 1e9, "ns")
+
+    def update_bullets() -> None:
+        for bullet in bullets:
+            bullet.turns_made += 1
+            bullet.direction = (bullet.direction + 1) % 8
+
+    t = best_time(update_bullets, n) / (len(bullets) * 2)
+    report("Bullet attribute update", t * 1e9, "ns")
+
+
+def bench_run(game_map: GameMap) -> None:
+    cowboy = game_map.cowboy_list[0]
+    n = 20_000
+    t = best_time(lambda: Run(6000, [0, 0, 0], game_map, cowboy), n)
+    report("Run creation", t * 1e9, "ns")
+
+    run = Run(10**9, [], game_map, cowboy)
+    t = best_time(lambda: run.add_steps(1), n)
+    report("Run.add_steps", t * 1e9, "ns")
+    report("Run instance size", instance_size(run), "B")
+
+
+def bench_distances(game_map: GameMap) -> None:
+    cowboys = game_map.cowboy_list[:20]
+    goals = [gold.position for gold in game_map.gold_list if gold.position is not None]
+    game_map.bfs_time = 0
+
+    def which_ways() -> None:
+        for cowboy in cowboys:
+            for goal in goals:
+                game_map.which_way(cowboy, goal)
+
+    def uncached_which_ways() -> None:
+        game_map.cached_distances = DistanceCache(game_map.DISTANCE_CACHE_SIZE, game_map.infty)
+        game_map.first_steps = {}
+        which_ways()
+
+    t = best_time(uncached_which_ways, 1) / (len(cowboys) * len(goals))
+    report("which_way with BFS (empty caches)", t * 1e6, "us")
+
+    t = timeit.timeit(lambda: DistanceTable(game_map.wall_grid, game_map.infty), number=1)
+    report("DistanceTable construction", t, "s")
+
+    with tempfile.TemporaryDirectory() as directory:
+        DistanceTable(game_map.wall_grid, game_map.infty, directory)
+        t = best_time(lambda: DistanceTable(game_map.wall_grid, game_map.infty, directory), 10)
+        report("DistanceTable mapped from an existing file", t * 1e3, "ms")
+
+    game_map.distance_table = DistanceTable(game_map.wall_grid, game_map.infty)
+    t = best_time(which_ways, 10) / (len(cowboys) * len(goals))
+    report("which_way with DistanceTable", t * 1e6, "us")
+    game_map.distance_table = None
+
+
+def queue_bfs(game_map: GameMap, start: Coords) -> list[list[int]]:
+    """`GameMap.bfs` as it was before `GridBFS`, for comparison."""
+    dists_from_start = [[game_map.infty for _ in range(game_map.width)] for _ in range(game_map.height)]
+    q: queue.Queue[tuple[int, Coords]] = queue.Queue()
+    q.put((0, start))
+    while not q.empty():
+        dist, (x, y) = q.get()
+        if dists_from_start[y][x] < game_map.infty or game_map.wall_grid[y][x]:
+            continue
+        dists_from_start[y][x] = dist
+        for d in cowboy_directions:
+            q.put((dist + 1, ((x + d.value[0]) % game_map.width, (y + d.value[1]) % game_map.height)))
+    return dists_from_start
+
+
+def bench_searches(name: str, game_map: GameMap) -> None:
+    """Note that golds and cowboys are respawned, the map changes."""
+    game_map.bfs_time = 0
+    start = game_map.cowboy_list[0].position
+    assert start is not None
+
+    t = best_time(lambda: queue_bfs(game_map, start), 10)
+    report(f"BFS with queue.Queue ({name})", t * 1e6, "us")
+    t = best_time(lambda: game_map.bfs(start, cowboy_directions), 10)
+    report(f"BFS with GridBFS ({name})", t * 1e6, "us")
+    t = best_time(game_map.random_free_position, 100)
+    report(f"random_free_position ({name})", t * 1e6, "us")
+
+    gold = game_map.gold_list[0]
+    cowboy = game_map.cowboy_list[0]
+
+    def respawn_gold() -> None:
+        assert gold.position is not None
+        game_map.gold_grid[gold.position[1]][gold.position[0]] = None
+        gold.position = None
+        game_map.spawn_gold(gold)
+
+    def respawn_cowboy() -> None:
+        assert cowboy.position is not None
+        game_map.cowboy_grid[cowboy.position[1]][cowboy.position[0]] = None
+        cowboy.position = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            game_map.spawn_cowboy(cowboy)
+
+    t = best_time(respawn_gold, 10)
+    report(f"spawn_gold ({name})", t * 1e6, "us")
+    t = best_time(respawn_cowboy, 10)
+    report(f"spawn_cowboy ({name})", t * 1e6, "us")
+
+
+def nested_loops_program(depth: int) -> str:
+    """Moves towards cowboy 0 inside `depth` nested loops, too many for generated
+    code (Python allows 20 nested blocks), so it runs as closures."""
+    xml = ('<block type="move_direction_number"><value name="DIRECTION"><block type="compute_direction">'
+           '<value name="POSITION"><block type="info_cowboy_position"><value name="COWBOY">'
+           '<block type="math_number"><field name="NUM">0</field></block></value></block></value>'
+           '</block></value></block>')
+    for _ in range(depth):
+        xml = ('<block type="controls_repeat_ext"><value name="TIMES"><block type="math_number">'
+               f'<field name="NUM">1</field></block></value><statement name="DO">{xml}</statement></block>')
+    return f'<xml xmlns="https://developers.google.com/blockly/xml">{xml}</xml>'
+
+
+def bench_parallel(turns: int = 10) -> None:
+    """Cowboy turns on the large map, half of the teams running the sample
+    program and half a program run as closures, one by one and in parallel
+    (see `blockly/parallel.py`). Parallel turns must end in the same state."""
+    parser = Parser(cowboy_factories)
+    programs = [parser.parse_program(SAMPLE_PROGRAM), parser.parse_program(nested_loops_program(25))]
+    assert programs[1].generated(True) is None and programs[1].generated(False) is None
+    serial_state = None
+    for workers in sorted({0, 2, os.cpu_count() or 1}):
+        random.seed(1)
+        teams = [Team(f"team{i}", "", load_from_file=False) for i in range(10)]
+        for i, team in enumerate(teams):
+            program = TeamProgram("bench", "", datetime.datetime.now(), programs[i % 2])
+            team.cowboy_programs = {"bench": program}
+            team.active_cowboy = "bench"
+        with tempfile.TemporaryDirectory() as save_dir, contextlib.redirect_stdout(io.StringIO()):
+            size, cowboys_per_team, gold_count, wall_fraction, cluster_max = MAPS["large"]
+            game_map = GameMap(width=size, height=size, teams=teams,
+                               cowboys_per_team=cowboys_per_team, gold_count=gold_count,
+                               wall_fraction=wall_fraction, cluster_max=cluster_max,
+                               save_dir=save_dir, parallel_workers=workers)
+            t = timeit.timeit(game_map.simulate_cowboys_turn, number=turns) / turns
+            game_map.close()
+        report(f"Cowboy turn ({workers} workers)", t * 1e3, "ms")
+        if workers:
+            report(f"Parallel results used ({workers} workers)",
+                   100 * game_map.speculative_reused / game_map.speculative_runs, "%")
+        state = game_map.get_state()
+        if serial_state is None:
+            serial_state = state
+        assert state == serial_state, f"Game with {workers} workers differs from the serial one"
+
+
+def bench_programs() -> None:
+    count = 200
+    size, roots = allocated(
+        lambda: [ParserInstance(cowboy_factories).parse_program(SAMPLE_PROGRAM)[0] for _ in range(count)])
+    report("Parsed program tree (blocks and fields)", size / count, "B")
+
+
+def main() -> None:
+    game_map = large_map()
+    bench_entities(game_map)
+    bench_run(game_map)
+    bench_distances(game_map)
+    bench_programs()
+    bench_parallel()
+    for name, params in MAPS.items():
+        bench_searches(name, make_map(*params))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Static analysis of parsed programs.
+
+`step_bound` computes the maximum number of steps a program could take in
+any game situation, if it can be proven (loops need constant bounds).
+Programs whose bound fits into the step limit could run without checking
+the limit at all.
+"""
+from __future__ import annotations
+
+from .blocks import (
+    Block, BlockInputKind, Constant, Nop, BulletFly, BulletLeft, BulletRight,
+    ControlsRepeatExt, ControlsFor, ControlsIf,
+)
+
+# Blocks which do not charge any steps themselves
+free_blocks: tuple[type, ...] = (Nop, BulletFly, BulletLeft, BulletRight)
+
+
+def step_bound(block: Block | None) -> int | None:
+    """Returns upper bound of steps of the chain starting with `block`
+    or None if there is no bound (or it cannot be proven)."""
+    total = 0
+    while block is not None:
+        bound = _block_bound(block)
+        if bound is None:
+            return None
+        total += bound
+        block = block.next if block.has_next else None
+    return total
+
+
+def _constant_int(block: Block) -> int | None:
+    if isinstance(block, Constant) and type(block.value) is int:
+        return block.value
+    return None
+
+
+def _range_length(start: int, to: int, by: int) -> int:
+    """Same as `len(range(start, to, by))` (without overflow), 0 for zero step."""
+    if by > 0:
+        return max(0, (to - start + by - 1) // by)
+    elif by < 0:
+        return max(0, (start - to - by - 1) // -by)
+    return 0
+
+
+def _block_bound(block: Block) -> int | None:
+    """Bound of `block` alone, without blocks after it."""
+    if isinstance(block, Constant):
+        return block.steps
+
+    if isinstance(block, ControlsIf):
+        total = 1
+        branches = [0]
+        for (condition, do) in block.conditions:
+            condition_bound = step_bound(condition)
+            do_bound = step_bound(do)
+            if condition_bound is None or do_bound is None:
+                return None
+            total += condition_bound
+            branches.append(do_bound)
+        else_bound = step_bound(block.do_else)
+        if else_bound is None:
+            return None
+        return total + max(branches + [else_bound])
+
+    # Values are evaluated once, statements are handled by the loops below
+    total = 0 if isinstance(block, free_blocks) else 1
+    for input in block.inputs:
+        if input.kind != BlockInputKind.VALUE:
+            continue
+        bound = step_bound(getattr(block, input.attr)) if input.attr is not None else None
+        if bound is None:
+            return None
+        total += bound
+
+    if isinstance(block, ControlsRepeatExt):
+        times = _constant_int(block.times)
+        do_bound = step_bound(block.do)
+        if times is None or do_bound is None:
+            return None
+        # Loops do not charge for themselves, only for every iteration
+        return total - 1 + max(times, 0) * (1 + do_bound)
+
+    if isinstance(block, ControlsFor):
+        start, to, by = _constant_int(block.block_from), _constant_int(block.block_to), _constant_int(block.block_by)
+        do_bound = step_bound(block.do)
+        if start is None or to is None or by is None or do_bound is None:
+            return None
+        return total - 1 + _range_length(start, to, by) * (1 + do_bound)
+
+    if any(input.kind == BlockInputKind.STATEMENT for input in block.inputs):
+        return None  # unknown statement block
+    return total
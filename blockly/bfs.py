@@ -0,0 +1,187 @@
+"""Breadth-first search over the squares of the (toroidal) map.
+
+Squares are numbered `y * width + x`. The neighbours of every square are
+precomputed once per map and the queue is a preallocated list, each square
+is queued at most once (it is marked when queued, not when taken out).
+
+If NumPy is installed, whole distance fields are computed by expanding the
+frontier of all squares at the same distance at once (shifting it by
+`np.roll` in every direction, masked by the blocked squares), which takes
+one vectorised step per unit of distance. That only pays off for fields from
+many sources (their frontiers meet soon) on large maps, a single source is
+as fast with the queue even on 200x200.
+
+Whether squares are connected is checked by growing searches from all of
+them in turns, a union-find tracks which searches have met. That stops as
+soon as they all meet or the ones which met cannot grow any more, so it
+costs about the size of the smaller side instead of the whole map.
+"""
+from __future__ import annotations
+from collections import deque
+from typing import Any, Iterable, Sequence
+
+from .actions import Direction
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Coords = tuple[int, int]
+
+# Smallest map (in squares) where fields from many sources are computed by NumPy
+NUMPY_MIN_CELLS = 4096
+
+
+class GridBFS:
+    width: int
+    height: int
+    cells: int
+    neighbours: list[tuple[int, ...]]  # by square, in the order of the directions
+    column_order: list[int]  # squares by columns (x, then y)
+    shifts: list[tuple[int, int]]  # (dy, dx) of the directions
+    _queue: list[int]
+    # Last `blocked` passed to `distances` and its NumPy array
+    _blocked: tuple[Sequence[bool], Any] | None
+
+    def __init__(self, width: int, height: int, directions: list[Direction]) -> None:
+        self.width = width
+        self.height = height
+        self.cells = width * height
+        self.neighbours = [
+            tuple(
+                ((y + d.value[1]) % height) * width + (x + d.value[0]) % width
+                for d in directions
+            )
+            for y in range(height) for x in range(width)
+        ]
+        self.column_order = [y * width + x for x in range(width) for y in range(height)]
+        self.shifts = [(d.value[1], d.value[0]) for d in directions]
+        self._queue = [0] * self.cells
+        self._blocked = None
+
+    def square(self, pos: Coords) -> int:
+        return pos[1] * self.width + pos[0]
+
+    def coords(self, square: int) -> Coords:
+        return (square % self.width, square // self.width)
+
+    def distances(self, sources: Iterable[int], blocked: Sequence[bool], infty: int) -> list[int]:
+        """Distance of each square from the nearest source, `infty` if it is
+        blocked or not reachable without entering blocked squares."""
+        sources = list(sources)
+        if np is not None and len(sources) > 1 and self.cells >= NUMPY_MIN_CELLS:
+            return self._numpy_distances(sources, blocked, infty)
+
+        dist = [infty] * self.cells
+        queue = self._queue
+        neighbours = self.neighbours
+        tail = 0
+        for s in sources:
+            if dist[s] == infty and not blocked[s]:
+                dist[s] = 0
+                queue[tail] = s
+                tail += 1
+        head = 0
+        while head < tail:
+            i = queue[head]
+            head += 1
+            d = dist[i] + 1
+            for j in neighbours[i]:
+                if dist[j] == infty and not blocked[j]:
+                    dist[j] = d
+                    queue[tail] = j
+                    tail += 1
+        return dist
+
+    def add_source(self, dist: list[int], source: int, blocked: Sequence[bool], infty: int) -> int:
+        """Updates `dist` from `distances` as if `source` was one of the sources,
+        only the squares which get closer are visited. Returns the change of
+        the sum of finite distances."""
+        if blocked[source] or dist[source] == 0:
+            return 0
+        change = -dist[source] if dist[source] != infty else 0
+        dist[source] = 0
+        queue = self._queue
+        neighbours = self.neighbours
+        queue[0] = source
+        head, tail = 0, 1
+        while head < tail:
+            i = queue[head]
+            head += 1
+            d = dist[i] + 1
+            for j in neighbours[i]:
+                if dist[j] > d and not blocked[j]:
+                    change += d - dist[j] if dist[j] != infty else d
+                    dist[j] = d
+                    queue[tail] = j
+                    tail += 1
+        return change
+
+    def _numpy_distances(self, sources: list[int], blocked: Sequence[bool], infty: int) -> list[int]:
+        if self._blocked is None or self._blocked[0] is not blocked:
+            free = ~np.array(blocked, dtype=bool).reshape(self.height, self.width)
+            self._blocked = (blocked, free)
+        free = self._blocked[1]
+
+        dist = np.full((self.height, self.width), infty, dtype=np.int64)
+        frontier = np.zeros((self.height, self.width), dtype=bool)
+        frontier.flat[sources] = True
+        frontier &= free
+        dist[frontier] = 0
+        unseen = free & ~frontier
+        d = 0
+        while frontier.any():
+            d += 1
+            expanded = np.zeros_like(frontier)
+            for shift in self.shifts:
+                expanded |= np.roll(frontier, shift, axis=(0, 1))
+            frontier = expanded & unseen
+            unseen &= ~frontier
+            dist[frontier] = d
+        return dist.ravel().tolist()
+
+    def connected(self, squares: Iterable[int], blocked: Sequence[bool]) -> bool:
+        """Whether all `squares` (which must not be blocked) reach each other
+        without entering blocked squares."""
+        squares = list(dict.fromkeys(squares))
+        if len(squares) <= 1:
+            return True
+        owner = {s: i for i, s in enumerate(squares)}  # search which reached each square
+        queues = [deque([s]) for s in squares]
+        parent = list(range(len(squares)))  # union-find of the searches which met
+        growing = [1] * len(squares)  # searches with a non-empty queue, by root
+        groups = len(squares)
+        neighbours = self.neighbours
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        while True:
+            for i, queue in enumerate(queues):
+                if not queue:
+                    continue
+                for j in neighbours[queue.popleft()]:
+                    if blocked[j]:
+                        continue
+                    o = owner.get(j)
+                    if o is None:
+                        owner[j] = i
+                        queue.append(j)
+                        continue
+                    a, b = find(i), find(o)
+                    if a != b:
+                        parent[b] = a
+                        growing[a] += growing[b]
+                        groups -= 1
+                        if groups == 1:
+                            return True
+                if not queue:
+                    root = find(i)
+                    growing[root] -= 1
+                    if growing[root] == 0:
+                        # Everything the searches of this group reach is seen
+                        return False
@@ -2,7 +2,8 @@ from __future__ import annotations
 from abc import abstractmethod
 from dataclasses import dataclass
 from enum import Enum
-from typing import Any, Type, TypeAlias, TypeVar, TYPE_CHECKING, cast
+import operator
+from typing import Any, Callable, Type, TypeAlias, TypeVar, TYPE_CHECKING, cast
 
 from .actions import Action, ActionType, all_directions, cowboy_directions, bullet_directions
 from .exceptions import OutOfStepsException, ProgramParseException
@@ -14,30 +15,72 @@ if TYPE_CHECKING:
 Position = tuple[int, int]
 
 
+class Unset:
+    """Value of a variable of unknown type before its first assignment."""
+
+    def __repr__(self) -> str:
+        return "UNSET"
+
+
+UNSET = Unset()
+
+Value: TypeAlias = "bool | int | Position | Unset"
+
+# Initial values of variables by their type, other variables start as UNSET
+variable_defaults: dict[Any, bool | int | Position] = {
+    bool: False,
+    int: 0,
+    Position: (0, 0),
+}
+
+
 class Run:
+    __slots__ = ("max_steps", "steps", "variables", "map", "context", "memo")
     max_steps: int
     steps: int
-    variables: dict[str, int | bool | Position]
+    variables: list[Value]  # indexed by `VariableField.slot`
     map: GameMap
     context: Cowboy | Bullet
+    memo: dict[tuple, Any]  # results of `query` by the query and arguments
 
-    def __init__(self, max_steps: int, variables: dict[str, int | bool | Position],
+    def __init__(self, max_steps: int, variables: list[Value],
                  map: GameMap, context: Cowboy | Bullet) -> None:
         self.max_steps = max_steps
         self.steps = 0
         self.variables = variables
         self.map = map
         self.context = context
+        self.memo = {}
 
     def add_steps(self, steps: int):
         self.steps += steps
         if self.steps > self.max_steps:
             raise OutOfStepsException()
 
+    def query(self, name: str, *args: Any) -> Any:
+        """Calls the map method `name` with `args`. The map does not change
+        while the program runs, so each result is computed only once per run."""
+        key = (name, *args)
+        memo = self.memo
+        if key in memo:
+            return memo[key]
+        result = memo[key] = getattr(self.map, name)(*args)
+        return result
+
+
+class UncheckedRun(Run):
+    """Run of a program which is proven not to exceed `max_steps`
+    (see `analysis.step_bound`), steps are only counted."""
+    __slots__ = ()
+
+    def add_steps(self, steps: int):
+        self.steps += steps
+
 
 ################################################################################
 
 class Field:
+    __slots__ = ("name",)
     is_variable: bool = False
 
     name: str
@@ -51,12 +94,15 @@ class Field:
 
 
 class VariableField(Field):
+    __slots__ = ("var_type", "slot")
     is_variable = True
     var_type: type | Any
+    slot: int  # index into `Run.variables`
 
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, slot: int) -> None:
         self.name = name
         self.var_type = Any
+        self.slot = slot
 
     def __str__(self) -> str:
         return f"variable {self.name}"
@@ -66,10 +112,14 @@ class VariableField(Field):
         self.var_type = wanted
 
     def execute(self, run: Run) -> bool | int | Position:
-        return run.variables[self.name]
+        value = run.variables[self.slot]
+        if value is UNSET:
+            raise KeyError(self.name)
+        return value  # type: ignore
 
 
 class StaticField(Field):
+    __slots__ = ("value", "returns")
     # Cannot be Position
     value: bool | int | str
     returns: type
@@ -153,6 +203,7 @@ class BlockInput:
 ################################################################################
 
 class Block:
+    __slots__ = ("next",)
     is_blockly_default: bool = False  # do not generate JSON definition for this block
 
     # For generating Blockly definition and for checks:
@@ -264,6 +315,7 @@ class Block:
 
 
 class Nop(Block):
+    __slots__ = ()
     name = "nop"
     messages = ["Stát"]
     has_prev = True
@@ -275,6 +327,7 @@ class Nop(Block):
 
 
 class InfoTeam(Block):
+    __slots__ = ()
     name = "info_team"
     messages = ["Můj tým"]
     returns = int
@@ -287,6 +340,7 @@ class InfoTeam(Block):
 
 
 class InfoPoints(Block):
+    __slots__ = ()
     name = "info_points"
     messages = ["Počet bodů"]
     returns = int
@@ -299,6 +353,7 @@ class InfoPoints(Block):
 
 
 class InfoIndex(Block):
+    __slots__ = ()
     name = "info_index"
     messages = ["Můj index"]
     returns = int
@@ -311,6 +366,7 @@ class InfoIndex(Block):
 
 
 class InfoID(Block):
+    __slots__ = ()
     name = "info_id"
     messages = ["Moje ID"]
     returns = int
@@ -323,6 +379,7 @@ class InfoID(Block):
 
 
 class InfoMyDirection(Block):
+    __slots__ = ()
     name = "info_my_direction"
     messages = ["Můj směr"]
     returns = int
@@ -331,11 +388,13 @@ class InfoMyDirection(Block):
 
     def execute(self, run: Run) -> int:
         run.add_steps(1)
+        from .map import Bullet
         assert isinstance(run.context, Bullet)
         return run.context.direction
 
 
 class InfoMyRange(Block):
+    __slots__ = ()
     name = "info_my_range"
     messages = ["Zbývá kroků"]
     returns = int
@@ -344,11 +403,13 @@ class InfoMyRange(Block):
 
     def execute(self, run: Run) -> int:
         run.add_steps(1)
+        from .map import Bullet
         assert isinstance(run.context, Bullet)
         return run.map.BULLET_LIFETIME - run.context.turns_made
 
 
 class InfoTurn(Block):
+    __slots__ = ()
     name = "info_turn"
     messages = ["Číslo kola"]
     returns = int
@@ -361,6 +422,7 @@ class InfoTurn(Block):
 
 
 class InfoMyPosition(Block):
+    __slots__ = ()
     name = "info_position"
     messages = ["Moje pozice"]
     returns = Position
@@ -375,6 +437,7 @@ class InfoMyPosition(Block):
 # Generic query:
 
 class InfoMapPosition(Block):
+    __slots__ = ("position", "entity")
     name = "info_map_position"
     messages = ["Je na %1 %2?"]
     inputs = [
@@ -410,6 +473,7 @@ class InfoMapPosition(Block):
 # Golds:
 
 class InfoGoldCount(Block):
+    __slots__ = ()
     name = "info_gold_count"
     messages = ["# zlata"]
     returns = int
@@ -422,6 +486,7 @@ class InfoGoldCount(Block):
 
 
 class InfoGoldPosition(Block):
+    __slots__ = ("gold_block",)
     name = "info_gold_position"
     messages = ["Pozice zlata %1"]
     inputs = [
@@ -443,6 +508,7 @@ class InfoGoldPosition(Block):
 # Cowboys:
 
 class InfoCowboyCount(Block):
+    __slots__ = ()
     name = "info_cowboy_count"
     messages = ["# kovbojů"]
     returns = int
@@ -455,6 +521,7 @@ class InfoCowboyCount(Block):
 
 
 class InfoCowboyTeam(Block):
+    __slots__ = ("cowboy_block",)
     name = "info_cowboy_team"
     messages = ["Tým kovboje %1"]
     inputs = [
@@ -474,6 +541,7 @@ class InfoCowboyTeam(Block):
 
 
 class InfoCowboyPosition(Block):
+    __slots__ = ("cowboy_block",)
     name = "info_cowboy_position"
     messages = ["Pozice kovboje %1"]
     inputs = [
@@ -495,6 +563,7 @@ class InfoCowboyPosition(Block):
 # Bullets:
 
 class InfoBulletCount(Block):
+    __slots__ = ()
     name = "info_bullet_count"
     messages = ["# střel"]
     returns = int
@@ -507,6 +576,7 @@ class InfoBulletCount(Block):
 
 
 class InfoBulletTeam(Block):
+    __slots__ = ("bullet_block",)
     name = "info_bullet_team"
     messages = ["Tým střely %1"]
     inputs = [
@@ -526,6 +596,7 @@ class InfoBulletTeam(Block):
 
 
 class InfoBulletPosition(Block):
+    __slots__ = ("bullet_block",)
     name = "info_bullet_position"
     messages = ["Pozice střely %1"]
     inputs = [
@@ -547,6 +618,7 @@ class InfoBulletPosition(Block):
 # Position transformations:
 
 class ModifyPosition(Block):
+    __slots__ = ("position", "direction")
     name = "modify_position"
     messages = ["posuň %1 o %2"]
     inputs = [
@@ -573,6 +645,7 @@ class ModifyPosition(Block):
 
 
 class TransformPositionX(Block):
+    __slots__ = ("block_position",)
     name = "transform_position_x"
     messages = ["%1→X"]
     inputs = [
@@ -591,6 +664,7 @@ class TransformPositionX(Block):
 
 
 class TransformPositionY(Block):
+    __slots__ = ("block_position",)
     name = "transform_position_y"
     messages = ["%1→Y"]
     inputs = [
@@ -609,6 +683,7 @@ class TransformPositionY(Block):
 
 
 class TransformXYPosition(Block):
+    __slots__ = ("block_x", "block_y")
     name = "transform_x_y_position"
     messages = ["(%1:%2)"]
     inputs = [
@@ -631,6 +706,7 @@ class TransformXYPosition(Block):
 
 
 class CountDistance(Block):
+    __slots__ = ("block_position",)
     name = "count_distance"
     messages = ["Přímá vzdálenost k %1"]
     inputs = [
@@ -650,6 +726,7 @@ class CountDistance(Block):
 
 
 class GetDirection(Block):
+    __slots__ = ("pos",)
     name = "compute_direction"
     messages = ["Směr k %1"]
     inputs = [
@@ -665,42 +742,14 @@ class GetDirection(Block):
         pos = cast(Position, self.pos.execute(run))
         run.add_steps(1)
         assert run.context.position is not None
-
-        x, y = run.context.position
-        tx, ty = pos
-        dx, dy = (tx - x, ty - y)
-
-        # Wrap over the edge of the map
-        if dx > run.map.width/2:
-            dx -= run.map.width
-        elif dx < -run.map.width/2:
-            dx += run.map.width
-
-        if dy > run.map.height/2:
-            dy -= run.map.height
-        elif dy < -run.map.height/2:
-            dy += run.map.height
-
-        out_x, out_y = 0, 0
-        # if difference in one axis is more than twice the difference in the
-        # other axis -> move only in one axis
-        if abs(dy) <= 2*abs(dx):
-            out_x = 1 if dx > 0 else -1
-        if abs(dx) <= 2*abs(dy):
-            out_y = 1 if dy > 0 else -1
-        direction = (out_x, out_y)
-
-        for i, d in enumerate(bullet_directions):
-            if d.value == direction:
-                return i
-
-        print(f"ERROR in ComputeDirection: {direction} not found")
-        return -1  # Should not happen
+        from .compiler import direction_towards
+        return direction_towards(run.map.width, run.map.height, run.context.position, pos)
 
 
 # Computations:
 
 class ComputeDistance(Block):
+    __slots__ = ("pos",)
     name = "compute_distance"
     messages = ["Počet kroků k %1"]
     inputs = [
@@ -715,11 +764,13 @@ class ComputeDistance(Block):
     def execute(self, run: Run) -> int:
         pos = cast(Position, self.pos.execute(run))
         run.add_steps(1)
+        from .map import Cowboy
         assert isinstance(run.context, Cowboy)
-        return run.map.distance_from(run.context, pos)
+        return run.query("distance_from", run.context, pos)
 
 
 class ComputeFirstStep(Block):
+    __slots__ = ("pos",)
     name = "compute_first_step"
     messages = ["První krok k %1"]
     inputs = [
@@ -736,8 +787,9 @@ class ComputeFirstStep(Block):
     def execute(self, run: Run) -> int:
         pos = cast(Position, self.pos.execute(run))
         run.add_steps(1)
+        from .map import Cowboy
         assert isinstance(run.context, Cowboy)
-        direction = run.map.which_way(run.context, pos)
+        direction = run.query("which_way", run.context, pos)
         for i, d in enumerate(all_directions):
             if d.value == direction:
                 return i
@@ -747,6 +799,8 @@ class ComputeFirstStep(Block):
 # Variables:
 
 class VariablesGet(Block):
+    # `returns` is set per instance, class attributes stay for `json_definition`
+    __slots__ = ("var", "__dict__")
     name = "variables_get"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "var", "VAR", variable=True),
@@ -766,6 +820,7 @@ class VariablesGet(Block):
 
 
 class VariablesSet(Block):
+    __slots__ = ("var", "value")
     name = "variables_set"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "var", "VAR", variable=True),
@@ -789,11 +844,12 @@ class VariablesSet(Block):
         run.add_steps(1)
         ret = self.value.execute(run)
         assert ret is not None and not isinstance(ret, Action)
-        run.variables[self.var.name] = ret
+        run.variables[self.var.slot] = ret
         return super().execute(run)
 
 
 class MathChange(Block):
+    __slots__ = ("var", "delta")
     name = "math_change"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "var", "VAR", int, variable=True),
@@ -817,11 +873,12 @@ class MathChange(Block):
         run.add_steps(1)
         delta = self.delta.execute(run)
         assert isinstance(delta, int)
-        run.variables[self.var.name] += delta  # type: ignore
+        run.variables[self.var.slot] += delta  # type: ignore
         return super().execute(run)
 
 
 class LogicBoolean(Block):
+    __slots__ = ("field",)
     name = "logic_boolean"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "field", "BOOL", bool),
@@ -839,6 +896,7 @@ class LogicBoolean(Block):
 
 
 class ConstantDirection(Block):
+    __slots__ = ("direction",)
     name = "constant_direction"
     messages = ["%1"]
     inputs = [
@@ -855,12 +913,27 @@ class ConstantDirection(Block):
 
     def execute(self, run: Run) -> int:
         run.add_steps(1)
-        ret = self.direction.execute(run)
-        assert isinstance(ret, int)
+        # Dropdown values are strings ("0" to "7")
+        ret = int(self.direction.execute(run))
         return ret
 
 
+def _false(A: Any, B: Any) -> bool:
+    return False  # should not happen
+
+
+compare_operators: dict[str, Callable[[Any, Any], bool]] = {
+    "EQ": operator.eq,
+    "NEQ": operator.ne,
+    "LT": operator.lt,
+    "LTE": operator.le,
+    "GT": operator.gt,
+    "GTE": operator.ge,
+}
+
+
 class LogicCompare(Block):
+    __slots__ = ("op", "block_A", "block_B", "operation")
     name = "logic_compare"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "op", "OP", str, dropdown=[]),  # TODO: add dropdown
@@ -873,29 +946,31 @@ class LogicCompare(Block):
     op: Field
     block_A: Block
     block_B: Block
+    operation: Callable[[Any, Any], bool]  # resolved `op`
+
+    def __init__(self, mutation: dict[str, str],
+                 fields: dict[str, Field], values: dict[str, Block],
+                 statements: dict[str, Block], next: Block | None) -> None:
+
+        super().__init__(mutation, fields, values, statements, next)
+        self.operation = compare_operators.get(cast(StaticField, self.op).value, _false)  # type: ignore
 
     def execute(self, run: Run) -> bool:
         run.add_steps(1)
-        op = self.op.execute(run)
         # A and B could be any comparable type:
         A = self.block_A.execute(run)
         B = self.block_B.execute(run)
-        if op == "EQ":
-            return A == B
-        elif op == "NEQ":
-            return A != B
-        elif op == "LT":
-            return A < B  # type: ignore
-        elif op == "LTE":
-            return A <= B  # type: ignore
-        elif op == "GT":
-            return A > B  # type: ignore
-        elif op == "GTE":
-            return A >= B  # type: ignore
-        return False  # should not happen
+        return self.operation(A, B)
+
+
+logic_operators: dict[str, Callable[[bool, bool], bool]] = {
+    "AND": lambda A, B: A and B,
+    "OR": lambda A, B: A or B,
+}
 
 
 class LogicOperation(Block):
+    __slots__ = ("op", "block_A", "block_B", "operation")
     name = "logic_operation"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "op", "OP", str, dropdown=[]),  # TODO: add dropdown
@@ -908,21 +983,25 @@ class LogicOperation(Block):
     op: Field
     block_A: Block
     block_B: Block
+    operation: Callable[[bool, bool], bool]  # resolved `op`
+
+    def __init__(self, mutation: dict[str, str],
+                 fields: dict[str, Field], values: dict[str, Block],
+                 statements: dict[str, Block], next: Block | None) -> None:
+
+        super().__init__(mutation, fields, values, statements, next)
+        self.operation = logic_operators.get(cast(StaticField, self.op).value, _false)  # type: ignore
 
     def execute(self, run: Run) -> bool:
         run.add_steps(1)
-        op = self.op.execute(run)
         A = self.block_A.execute(run)
         B = self.block_B.execute(run)
         assert isinstance(A, bool) and isinstance(B, bool)
-        if op == "AND":
-            return A and B
-        elif op == "OR":
-            return A or B
-        return False  # should not happen
+        return self.operation(A, B)
 
 
 class LogicNegate(Block):
+    __slots__ = ("bool_child",)
     name = "logic_negate"
     inputs = [
         BlockInput(BlockInputKind.VALUE, "bool_child", "BOOL", bool),
@@ -938,6 +1017,7 @@ class LogicNegate(Block):
 
 
 class MathNumber(Block):
+    __slots__ = ("field",)
     name = "math_number"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "field", "NUM", int),
@@ -955,6 +1035,7 @@ class MathNumber(Block):
 
 
 class MathAbs(Block):
+    __slots__ = ("number",)
     name = "math_abs"
     messages = ["abs %1"]
     inputs = [
@@ -973,7 +1054,22 @@ class MathAbs(Block):
         return abs(ret)
 
 
+arithmetic_operators: dict[str, Callable[[int, int], int]] = {
+    "ADD": operator.add,
+    "MINUS": operator.sub,
+    "MULTIPLY": operator.mul,
+    "DIVIDE": operator.floordiv,
+    "POWER": operator.pow,
+    "MODULO": operator.mod,
+}
+
+
+def _zero(A: int, B: int) -> int:
+    return 0  # should not happen
+
+
 class MathArithmeticCustom(Block):
+    __slots__ = ("op", "block_A", "block_B", "operation")
     name = "math_arithmetic_custom"
     messages = ["%2%1%3"]
     inputs = [
@@ -993,29 +1089,46 @@ class MathArithmeticCustom(Block):
     op: Field
     block_A: Block
     block_B: Block
+    operation: Callable[[int, int], int]  # resolved `op`
+
+    def __init__(self, mutation: dict[str, str],
+                 fields: dict[str, Field], values: dict[str, Block],
+                 statements: dict[str, Block], next: Block | None) -> None:
+
+        super().__init__(mutation, fields, values, statements, next)
+        self.operation = arithmetic_operators.get(cast(StaticField, self.op).value, _zero)  # type: ignore
 
     def execute(self, run: Run) -> int:
         run.add_steps(1)
-        op = self.op.execute(run)
         A = self.block_A.execute(run)
         B = self.block_B.execute(run)
         assert isinstance(A, int) and isinstance(B, int)
-        if op == "ADD":
-            return A + B
-        elif op == "MINUS":
-            return A - B
-        elif op == "MULTIPLY":
-            return A * B
-        elif op == "DIVIDE":
-            return A // B
-        elif op == "POWER":
-            return A ** B
-        elif op == "MODULO":
-            return A % B
-        return 0  # should not happen
+        return self.operation(A, B)
+
+
+class Constant(Block):
+    """Result of constant subtree computed by `optimizer.fold_constants`,
+    not available in Blockly. Charges all steps of the subtree at once."""
+    # `returns` is set per instance
+    __slots__ = ("value", "steps", "__dict__")
+    name = "constant"
+
+    value: bool | int | Position
+    steps: int
+
+    def __init__(self, value: bool | int | Position, steps: int, returns: None | type | TypeAlias) -> None:
+        super().__init__({}, {}, {}, {}, None)
+        self.value = value
+        self.steps = steps
+        self.returns = returns
+
+    def execute(self, run: Run) -> bool | int | Position:
+        run.add_steps(self.steps)
+        return self.value
 
 
 class MoveDirection(Block):
+    __slots__ = ("direction",)
     name = "move_direction"
     messages = ["Move %1"]
     inputs = [
@@ -1039,6 +1152,7 @@ class MoveDirection(Block):
 
 
 class BulletFly(Block):
+    __slots__ = ()
     name = "bullet_fly"
     messages = ["Rovně"]
     has_prev = True
@@ -1050,6 +1164,7 @@ class BulletFly(Block):
 
 
 class BulletLeft(Block):
+    __slots__ = ()
     name = "bullet_left"
     messages = ["Doleva"]
     has_prev = True
@@ -1061,6 +1176,7 @@ class BulletLeft(Block):
 
 
 class BulletRight(Block):
+    __slots__ = ()
     name = "bullet_right"
     messages = ["Doprava"]
     has_prev = True
@@ -1072,6 +1188,7 @@ class BulletRight(Block):
 
 
 class FireDirection(Block):
+    __slots__ = ("direction",)
     name = "fire_direction"
     messages = ["Fire %1"]
     inputs = [
@@ -1096,6 +1213,7 @@ class FireDirection(Block):
 
 
 class MoveDirectionByNumber(Block):
+    __slots__ = ("direction",)
     name = "move_direction_number"
     messages = ["Move %1"]
     inputs = [
@@ -1119,6 +1237,7 @@ class MoveDirectionByNumber(Block):
 
 
 class FireDirectionByNumber(Block):
+    __slots__ = ("direction",)
     name = "fire_direction_by_number"
     messages = ["Fire %1"]
     inputs = [
@@ -1141,6 +1260,7 @@ class FireDirectionByNumber(Block):
 
 
 class ControlsRepeatExt(Block):
+    __slots__ = ("times", "do")
     name = "controls_repeat_ext"
     inputs = [
         BlockInput(BlockInputKind.VALUE, "times", "TIMES", int),
@@ -1166,6 +1286,7 @@ class ControlsRepeatExt(Block):
 
 
 class ControlsFor(Block):
+    __slots__ = ("var", "block_from", "block_to", "block_by", "do")
     name = "controls_for"
     inputs = [
         BlockInput(BlockInputKind.FIELD, "var", "VAR", int, variable=True),
@@ -1194,7 +1315,7 @@ class ControlsFor(Block):
 
         for i in range(start, to, by):
             run.add_steps(1)
-            run.variables[self.var.name] = i
+            run.variables[self.var.slot] = i
             ret = self.do.execute(run)
             if ret is not None:
                 return ret
@@ -1203,12 +1324,14 @@ class ControlsFor(Block):
 
 
 class ControlsIf(Block):
+    # `inputs` depend on mutation and are set per instance
+    __slots__ = ("conditions", "do_else", "__dict__")
     name = "controls_if"
     is_blockly_default = True
     has_prev = True
     has_next = True
 
-    conditions: list[tuple[Block, Block]]
+    conditions: list[tuple[Block, Block | None]]  # `do` is None if it could not be reached
     do_else: Block | None
 
     def __init__(self, mutation: dict[str, str],
@@ -1244,7 +1367,8 @@ class ControlsIf(Block):
         for (condition, do) in self.conditions:
             if condition.execute(run) is True:
                 found = True
-                ret = do.execute(run)
+                if do is not None:
+                    ret = do.execute(run)
                 break
 
         if not found and self.do_else is not None:
@@ -0,0 +1,620 @@
+"""Generation of Python source code from parsed programs.
+
+The whole program becomes one Python function `program(run)`: variables are
+locals, `ControlsRepeatExt`/`ControlsFor` are native `for` loops and
+`ControlsIf` is `if/else`. Steps are counted in a local variable which is
+written back to `run.steps` when the function ends.
+
+Steps of straight-line code are charged in one increment (and one check)
+right before the first line which could fail or leave the straight-line
+code (map queries, asserts, division, `return`, loops and branches). Lines
+which cannot fail are free to run before the check, so the program runs out
+of steps (or fails) at the same point with the same step count as with
+`Block.execute`. Programs which cannot exceed the step limit (see
+`analysis.step_bound`) could be generated without the checks.
+
+Queries which cannot change during the run (the map changes only after the
+program returns) are computed once per run if they are used inside loops,
+their later uses only charge the step.
+
+Generated functions are cached per program XML, so all cowboys (and teams)
+running the same program share one compiled function. The cache keeps the
+`CACHE_SIZE` least recently used programs, older versions of programs are
+dropped.
+"""
+from __future__ import annotations
+import hashlib
+from collections import OrderedDict
+from typing import Any, Callable, Type, TYPE_CHECKING
+
+from .actions import Action, ActionType, all_directions, cowboy_directions, bullet_directions
+from .blocks import (
+    Block, Field, StaticField, VariableField, UNSET, variable_defaults,
+    Nop, InfoTeam, InfoPoints, InfoIndex, InfoID, InfoMyDirection, InfoMyRange, InfoTurn, InfoMyPosition,
+    InfoMapPosition, InfoGoldCount, InfoGoldPosition, InfoCowboyCount, InfoCowboyTeam, InfoCowboyPosition,
+    InfoBulletCount, InfoBulletTeam, InfoBulletPosition,
+    ModifyPosition, TransformPositionX, TransformPositionY, TransformXYPosition, CountDistance, GetDirection,
+    ComputeDistance, ComputeFirstStep,
+    VariablesGet, VariablesSet, MathChange,
+    LogicBoolean, ConstantDirection, LogicCompare, LogicOperation, LogicNegate,
+    MathNumber, MathAbs, MathArithmeticCustom, Constant,
+    MoveDirection, BulletFly, BulletLeft, BulletRight, FireDirection, MoveDirectionByNumber, FireDirectionByNumber,
+    ControlsRepeatExt, ControlsFor, ControlsIf,
+)
+from .compiler import Compiled, direction_towards
+from .exceptions import OutOfStepsException
+
+if TYPE_CHECKING:
+    from .program import Program
+
+
+class CodegenException(Exception):
+    """Program could not be turned into Python code (use other engine)."""
+    pass
+
+
+value_generators: dict[Type[Block], Callable[[Any, Any], str]] = {}
+statement_generators: dict[Type[Block], Callable[[Any, Any], bool]] = {}
+
+
+def generates(*block_types: Type[Block]):
+    """Registers generator of a value/action block, returns Python expression."""
+    def decorator(f):
+        for block_type in block_types:
+            value_generators[block_type] = f
+        return f
+    return decorator
+
+
+def generates_statement(*block_types: Type[Block]):
+    """Registers generator of a statement block, returns whether the chain
+    should continue with `next` (False if the generator handled it)."""
+    def decorator(f):
+        for block_type in block_types:
+            statement_generators[block_type] = f
+        return f
+    return decorator
+
+
+class SourceGenerator:
+    """Generates source of one program, should not be reused."""
+    lines: list[str]
+    indent: int
+    namespace: dict[str, Any]
+    variables: dict[str, type | Any]  # variables of the program in the order of slots
+    checked: bool  # check the step limit
+    temps: int
+    pending: int  # steps not charged yet
+    known_types: dict[str, type]  # expressions which are surely instances of the type
+    literals: dict[str, Any]  # expressions with known value
+    loops: int  # number of loops around the generated code
+    invariants: dict[str, str]  # locals keeping results of run invariant queries, by the query
+
+    def __init__(self, variables: dict[str, type | Any], checked: bool = True) -> None:
+        self.lines = []
+        self.indent = 2
+        self.namespace = {
+            "OutOfStepsException": OutOfStepsException,
+            "Action": Action,
+            "UNSET": UNSET,
+            "direction_towards": direction_towards,
+        }
+        self.variables = variables
+        self.checked = checked
+        self.temps = 0
+        self.pending = 0
+        self.known_types = {}
+        self.literals = {}
+        self.loops = 0
+        self.invariants = {}
+
+    def emit(self, line: str, safe: bool = False) -> None:
+        """Adds line of code, lines which are not `safe` (i.e. could raise or
+        have a visible effect) need all steps charged first."""
+        if not safe:
+            self.flush()
+        self.lines.append("    " * self.indent + line)
+
+    def begin(self, header: str) -> None:
+        self.emit(header)
+        self.indent += 1
+
+    def end(self) -> None:
+        self.flush()
+        self.indent -= 1
+
+    def new_temp(self) -> str:
+        name = f"t{self.temps}"
+        self.temps += 1
+        return name
+
+    def temp(self, expression: str, safe: bool = False, returns: type | None = None) -> str:
+        name = self.new_temp()
+        self.emit(f"{name} = {expression}", safe)
+        if returns is not None:
+            self.known_types[name] = returns
+        return name
+
+    def literal(self, value: Any) -> str:
+        expression = f"({value!r})"
+        self.literals[expression] = value
+        if type(value) in (bool, int):
+            self.known_types[expression] = type(value)
+        return expression
+
+    def invariant(self, expression: str) -> str:
+        """Local with value of `expression` which does not change during the
+        run, computed when it is used for the first time."""
+        name = self.invariants.get(expression)
+        if name is None:
+            name = self.invariants[expression] = f"q{len(self.invariants)}"
+        self.emit(f"if {name} is UNSET: {name} = {expression}")
+        return name
+
+    def check_type(self, t: type, *expressions: str) -> None:
+        """Asserts all expressions are instances of `t` (if not known)."""
+        checks = [f"isinstance({e}, {t.__name__})" for e in expressions if not self.is_instance(e, t)]
+        if checks:
+            self.emit(f"assert {' and '.join(checks)}")
+
+    def is_instance(self, expression: str, t: type) -> bool:
+        known = self.known_types.get(expression)
+        return known is not None and issubclass(known, t)
+
+    def constant(self, value: Any) -> str:
+        name = f"c{len(self.namespace)}"
+        self.namespace[name] = value
+        return name
+
+    def local(self, field: Field) -> str:
+        assert isinstance(field, VariableField)
+        return f"v{field.slot}"
+
+    def charge(self, steps: int = 1) -> None:
+        self.pending += steps
+
+    def flush(self) -> None:
+        if self.pending > 0:
+            self.lines.append("    " * self.indent + f"steps += {self.pending}")
+            if self.checked:
+                self.lines.append("    " * self.indent + "if steps > max_steps: raise OutOfStepsException()")
+            self.pending = 0
+
+    def value(self, block: Block) -> str:
+        generator = value_generators.get(type(block))
+        if generator is None:
+            raise CodegenException(f"No code generator for {block}")
+        return generator(self, block)
+
+    def chain(self, block: Block | None) -> None:
+        while block is not None:
+            statement = statement_generators.get(type(block))
+            if statement is None:
+                # Last block of the chain, its value is the result
+                self.emit(f"return {self.value(block)}")
+                return
+            if not statement(self, block):
+                return
+            block = block.next
+
+    def source(self, root: Block) -> str:
+        self.chain(root)
+        self.emit("return None")
+        body = self.lines
+
+        self.lines = []
+        self.indent = 0
+        self.emit("def program(run):")
+        self.indent = 1
+        self.emit("steps = run.steps")
+        self.emit("max_steps = run.max_steps")
+        self.emit("map = run.map")
+        self.emit("context = run.context")
+        for slot, (name, t) in enumerate(self.variables.items()):
+            self.emit(f"v{slot} = {variable_defaults.get(t, UNSET)!r}  # {name!r}")
+        for expression, name in self.invariants.items():
+            self.emit(f"{name} = UNSET  # {expression}")
+        self.emit("try:")
+        self.lines.extend(body)
+        self.emit("finally:")
+        self.emit("    run.steps = steps")
+        return "\n".join(self.lines) + "\n"
+
+
+def _field_value(field: Field) -> Any:
+    assert isinstance(field, StaticField)
+    return field.value
+
+
+################################################################################
+# Game info
+
+def _simple_query(expression: str, safe: bool = False, invariant: bool = False):
+    """Query without inputs, `invariant` queries are computed only once in loops."""
+    def generator(gen: SourceGenerator, block: Block) -> str:
+        gen.charge()
+        if invariant and gen.loops > 0:
+            return gen.invariant(expression)
+        return gen.temp(expression, safe)
+    return generator
+
+
+generates(InfoTeam)(_simple_query("context.team", safe=True))
+generates(InfoPoints)(_simple_query("map.my_points(context)", invariant=True))
+generates(InfoIndex)(_simple_query("context.index", safe=True))
+generates(InfoID)(_simple_query("map.my_id(context)", invariant=True))
+generates(InfoTurn)(_simple_query("map.turn_idx", safe=True))
+generates(InfoMyPosition)(_simple_query("map.my_position(context)", invariant=True))
+generates(InfoGoldCount)(_simple_query("map.number_of_golds()", invariant=True))
+generates(InfoCowboyCount)(_simple_query("map.number_of_cowboys()", invariant=True))
+generates(InfoBulletCount)(_simple_query("map.number_of_bullets()", invariant=True))
+
+
+@generates(InfoMyDirection, InfoMyRange)
+def _bullet_info(gen: SourceGenerator, block: Block) -> str:
+    from .map import Bullet
+    gen.charge()
+    gen.emit(f"assert isinstance(context, {gen.constant(Bullet)})")
+    if isinstance(block, InfoMyDirection):
+        return gen.temp("context.direction", safe=True)
+    return gen.temp("map.BULLET_LIFETIME - context.turns_made", safe=True)
+
+
+@generates(InfoMapPosition)
+def _info_map_position(gen: SourceGenerator, block: InfoMapPosition) -> str:
+    gen.charge()
+    c, r = gen.new_temp(), gen.new_temp()
+    gen.emit(f"({c}, {r}) = {gen.value(block.position)}")
+    entity = _field_value(block.entity)
+    if entity == "WALL":
+        return gen.temp(f"map.wall_grid[{r}][{c}]")
+    elif entity == "GOLD":
+        return gen.temp(f"map.gold_grid[{r}][{c}] is not None")
+    elif entity == "COWBOY":
+        return gen.temp(f"map.cowboy_grid[{r}][{c}] is not None")
+    elif entity == "BULLET":
+        return gen.temp(f"map.bullet_grid[{r}][{c}] is not None")
+    return "False"  # should not happen
+
+
+def _indexed_query(attr: str, query: str):
+    def generator(gen: SourceGenerator, block: Block) -> str:
+        gen.charge()
+        i = gen.value(getattr(block, attr))
+        gen.check_type(int, i)
+        return gen.temp(f"map.{query}({i})")
+    return generator
+
+
+generates(InfoGoldPosition)(_indexed_query("gold_block", "gold_i_position"))
+generates(InfoCowboyTeam)(_indexed_query("cowboy_block", "cowboy_i_team"))
+generates(InfoCowboyPosition)(_indexed_query("cowboy_block", "cowboy_i_position"))
+generates(InfoBulletTeam)(_indexed_query("bullet_block", "bullet_i_team"))
+generates(InfoBulletPosition)(_indexed_query("bullet_block", "bullet_i_position"))
+
+
+################################################################################
+# Positions
+
+@generates(ModifyPosition)
+def _modify_position(gen: SourceGenerator, block: ModifyPosition) -> str:
+    gen.charge()
+    x, y = gen.new_temp(), gen.new_temp()
+    gen.emit(f"({x}, {y}) = {gen.value(block.position)}")
+    direction = gen.value(block.direction)
+    gen.emit(f"assert type({direction}) is int")
+    dx, dy = gen.new_temp(), gen.new_temp()
+    deltas = gen.constant([d.value for d in all_directions])
+    gen.emit(f"({dx}, {dy}) = {deltas}[{direction} % 8]", safe=True)
+    return gen.temp(f"(({x} + {dx}) % map.width, ({y} + {dy}) % map.height)", safe=True)
+
+
+@generates(TransformPositionX, TransformPositionY)
+def _transform_position(gen: SourceGenerator, block: TransformPositionX | TransformPositionY) -> str:
+    gen.charge()
+    position = gen.value(block.block_position)
+    return gen.temp(f"{position}[{0 if isinstance(block, TransformPositionX) else 1}]")
+
+
+@generates(TransformXYPosition)
+def _transform_x_y_position(gen: SourceGenerator, block: TransformXYPosition) -> str:
+    gen.charge()
+    x = gen.value(block.block_x)
+    y = gen.value(block.block_y)
+    gen.check_type(int, x, y)
+    return gen.temp(f"({x}, {y})", safe=True)
+
+
+@generates(CountDistance)
+def _count_distance(gen: SourceGenerator, block: CountDistance) -> str:
+    gen.charge()
+    position = gen.value(block.block_position)
+    gen.emit("assert context.position is not None")
+    return gen.temp(f"map.maximum_metric(context.position, {position})")
+
+
+@generates(GetDirection)
+def _get_direction(gen: SourceGenerator, block: GetDirection) -> str:
+    position = gen.value(block.pos)
+    gen.charge()
+    gen.emit("assert context.position is not None")
+    return gen.temp(f"direction_towards(map.width, map.height, context.position, {position})")
+
+
+@generates(ComputeDistance, ComputeFirstStep)
+def _compute_path(gen: SourceGenerator, block: ComputeDistance | ComputeFirstStep) -> str:
+    from .map import Cowboy
+    position = gen.value(block.pos)
+    gen.charge()
+    gen.emit(f"assert isinstance(context, {gen.constant(Cowboy)})")
+    if isinstance(block, ComputeDistance):
+        return gen.temp(f"run.query('distance_from', context, {position})")
+    indices = gen.constant({d.value: i for i, d in enumerate(all_directions)})
+    return gen.temp(f"{indices}.get(run.query('which_way', context, {position}), -1)")
+
+
+################################################################################
+# Variables
+
+@generates(VariablesGet)
+def _variables_get(gen: SourceGenerator, block: VariablesGet) -> str:
+    gen.charge()
+    local = gen.local(block.var)
+    if gen.variables[block.var.name] not in variable_defaults:
+        # Variable of unknown type could be read before it was set
+        gen.emit(f"if {local} is UNSET: raise KeyError({block.var.name!r})")
+    return local
+
+
+@generates_statement(VariablesSet)
+def _variables_set(gen: SourceGenerator, block: VariablesSet) -> bool:
+    gen.charge()
+    value = gen.value(block.value)
+    gen.emit(f"{gen.local(block.var)} = {value}", safe=True)
+    return True
+
+
+@generates_statement(MathChange)
+def _math_change(gen: SourceGenerator, block: MathChange) -> bool:
+    gen.charge()
+    delta = gen.value(block.delta)
+    gen.check_type(int, delta)
+    gen.emit(f"{gen.local(block.var)} += {delta}", safe=True)
+    return True
+
+
+################################################################################
+# Logic and math
+
+@generates(LogicBoolean, MathNumber)
+def _constant(gen: SourceGenerator, block: LogicBoolean | MathNumber) -> str:
+    gen.charge()
+    value = _field_value(block.field)
+    if not isinstance(value, bool if isinstance(block, LogicBoolean) else int):
+        gen.emit("raise AssertionError()")
+    return gen.literal(value)
+
+
+@generates(ConstantDirection)
+def _constant_direction(gen: SourceGenerator, block: ConstantDirection) -> str:
+    gen.charge()
+    raw_value = _field_value(block.direction)
+    try:
+        return gen.literal(int(raw_value))
+    except ValueError:
+        return gen.temp(f"int({raw_value!r})")
+
+
+compare_operators: dict[str, str] = {
+    "EQ": "==",
+    "NEQ": "!=",
+    "LT": "<",
+    "LTE": "<=",
+    "GT": ">",
+    "GTE": ">=",
+}
+
+
+@generates(LogicCompare)
+def _logic_compare(gen: SourceGenerator, block: LogicCompare) -> str:
+    gen.charge()
+    A = gen.value(block.block_A)
+    B = gen.value(block.block_B)
+    op = compare_operators.get(_field_value(block.op))
+    if op is None:
+        return "False"  # should not happen
+    # Ordering of values of different types raises TypeError
+    safe = op in ("==", "!=") or (gen.is_instance(A, int) and gen.is_instance(B, int))
+    return gen.temp(f"{A} {op} {B}", safe, returns=bool)
+
+
+@generates(LogicOperation)
+def _logic_operation(gen: SourceGenerator, block: LogicOperation) -> str:
+    gen.charge()
+    A = gen.value(block.block_A)
+    B = gen.value(block.block_B)
+    gen.check_type(bool, A, B)
+    op = {"AND": "and", "OR": "or"}.get(_field_value(block.op))
+    if op is None:
+        return "False"  # should not happen
+    return gen.temp(f"{A} {op} {B}", safe=True, returns=bool)
+
+
+@generates(LogicNegate)
+def _logic_negate(gen: SourceGenerator, block: LogicNegate) -> str:
+    gen.charge()
+    return gen.temp(f"not {gen.value(block.bool_child)}", safe=True, returns=bool)
+
+
+@generates(MathAbs)
+def _math_abs(gen: SourceGenerator, block: MathAbs) -> str:
+    gen.charge()
+    number = gen.value(block.number)  # type: ignore
+    gen.check_type(int, number)
+    return gen.temp(f"abs({number})", safe=True, returns=int)
+
+
+arithmetic_operators: dict[str, str] = {
+    "ADD": "+",
+    "MINUS": "-",
+    "MULTIPLY": "*",
+    "DIVIDE": "//",
+    "POWER": "**",
+    "MODULO": "%",
+}
+
+
+@generates(MathArithmeticCustom)
+def _math_arithmetic_custom(gen: SourceGenerator, block: MathArithmeticCustom) -> str:
+    gen.charge()
+    A = gen.value(block.block_A)
+    B = gen.value(block.block_B)
+    gen.check_type(int, A, B)
+    op = arithmetic_operators.get(_field_value(block.op))
+    if op is None:
+        return "0"  # should not happen
+    if op in ("//", "%"):
+        # Division by zero raises ZeroDivisionError
+        safe = gen.literals.get(B, 0) != 0
+    else:
+        # Power could be float or could take long
+        safe = op != "**"
+    return gen.temp(f"{A} {op} {B}", safe, returns=None if op == "**" else int)
+
+
+@generates(Constant)
+def _folded_constant(gen: SourceGenerator, block: Constant) -> str:
+    gen.charge(block.steps)
+    return gen.literal(block.value)
+
+
+################################################################################
+# Actions
+
+@generates(Nop, BulletFly, BulletLeft, BulletRight)
+def _constant_action(gen: SourceGenerator, block: Block) -> str:
+    action_type = {
+        BulletLeft: ActionType.BULLET_TURN_L,
+        BulletRight: ActionType.BULLET_TURN_R,
+    }.get(type(block), ActionType.NOP)
+    return gen.constant(Action(action_type))
+
+
+@generates(MoveDirection, FireDirection)
+def _direction_action(gen: SourceGenerator, block: MoveDirection | FireDirection) -> str:
+    gen.charge()
+    if isinstance(block, MoveDirection):
+        action_type, directions = ActionType.MOVE, cowboy_directions
+    else:
+        action_type, directions = ActionType.FIRE, bullet_directions
+    name = _field_value(block.direction)
+    for d in directions:
+        if d.name == name:
+            return gen.constant(Action(action_type, d))
+    return gen.constant(Action(ActionType.NOP))  # should not happen
+
+
+@generates(MoveDirectionByNumber, FireDirectionByNumber)
+def _number_action(gen: SourceGenerator, block: MoveDirectionByNumber | FireDirectionByNumber) -> str:
+    gen.charge()
+    i = gen.value(block.direction)  # type: ignore
+    gen.check_type(int, i)
+    if isinstance(block, MoveDirectionByNumber):
+        actions = [Action(ActionType.MOVE, cowboy_directions[i // 2]) for i in range(8)]
+    else:
+        actions = [Action(ActionType.FIRE, d) for d in bullet_directions]
+    nop = gen.constant(Action(ActionType.NOP))
+    return gen.temp(f"{nop} if {i} < 0 else {gen.constant(actions)}[{i} % 8]", safe=True)
+
+
+################################################################################
+# Control flow
+
+@generates_statement(ControlsRepeatExt)
+def _controls_repeat_ext(gen: SourceGenerator, block: ControlsRepeatExt) -> bool:
+    times = gen.value(block.times)
+    gen.check_type(int, times)
+    gen.begin(f"for _ in range({times}):")
+    gen.charge()
+    gen.loops += 1
+    gen.chain(block.do)
+    gen.loops -= 1
+    gen.end()
+    return True
+
+
+@generates_statement(ControlsFor)
+def _controls_for(gen: SourceGenerator, block: ControlsFor) -> bool:
+    start = gen.value(block.block_from)
+    to = gen.value(block.block_to)
+    by = gen.value(block.block_by)
+    gen.check_type(int, start, to, by)
+    # Zero step ends the chain, so the rest of it is generated inside the `if`
+    gen.begin(f"if {by} != 0:")
+    gen.begin(f"for {gen.local(block.var)} in range({start}, {to}, {by}):")
+    gen.charge()
+    gen.loops += 1
+    gen.chain(block.do)
+    gen.loops -= 1
+    gen.end()
+    gen.chain(block.next)
+    gen.end()
+    return False
+
+
+@generates_statement(ControlsIf)
+def _controls_if(gen: SourceGenerator, block: ControlsIf) -> bool:
+    gen.charge()
+    for (condition, do) in block.conditions:
+        value = gen.value(condition)
+        gen.begin(f"if {value} is True:")
+        gen.chain(do)
+        gen.emit("pass", safe=True)
+        gen.end()
+        gen.begin("else:")
+    gen.chain(block.do_else)
+    gen.emit("pass", safe=True)
+    for _ in block.conditions:
+        gen.end()
+    return True
+
+
+################################################################################
+
+def generate_source(root: Block, variables: dict[str, type | Any], checked: bool = True) -> tuple[str, dict[str, Any]]:
+    """Returns source of the function `program(run)` and its global namespace."""
+    gen = SourceGenerator(variables, checked)
+    return gen.source(root), gen.namespace
+
+
+# Programs in use at once: cowboy and bullet program of every team, checked and unchecked
+CACHE_SIZE = 64
+_cache: OrderedDict[str, Compiled | None] = OrderedDict()
+
+
+def generate(program: Program, checked: bool = True) -> Compiled | None:
+    """Returns the program compiled from generated Python code, or None
+    if it is not possible (e.g. too deeply nested program). Unless `checked`,
+    the step limit is not checked (only steps are counted)."""
+    if program.root is None or program.variables is None:
+        return None
+
+    key = hashlib.sha256(program.raw_xml.encode()).hexdigest()
+    if not checked:
+        key += "-unchecked"
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    function: Compiled | None = None
+    try:
+        source, namespace = generate_source(program.root, program.variables, checked)
+        exec(compile(source, f"<program {key[:12]}>", "exec"), namespace)
+        function = namespace["program"]
+    except (CodegenException, SyntaxError, RecursionError, MemoryError) as e:
+        print(f"WARN: Cannot generate code for program {key[:12]}: {e}")
+
+    _cache[key] = function
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return function
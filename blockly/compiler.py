@@ -0,0 +1,730 @@
+"""Compilation of Block trees into nested Python closures.
+
+Each block is turned (once, after parsing) into a function taking `Run`, with
+operators, field values and child callables bound ahead of time. Compiled
+functions mirror `Block.execute` exactly, including the order in which steps
+are charged and the checks that may fail.
+
+Statement chains (blocks linked via `next`) are compiled into flat lists run
+in a loop instead of recursing through `Block.execute` for every block.
+
+Trees instrumented for profiling are compiled the same way, the closure of
+every `ProfiledBlock` is wrapped by `profiler.measure`.
+"""
+from __future__ import annotations
+import operator
+from typing import Any, Callable, Type
+
+from .actions import Action, ActionType, all_directions, cowboy_directions, bullet_directions
+from .blocks import (
+    Block, Field, Run, StaticField, UNSET,
+    Nop, InfoTeam, InfoPoints, InfoIndex, InfoID, InfoMyDirection, InfoMyRange, InfoTurn, InfoMyPosition,
+    InfoMapPosition, InfoGoldCount, InfoGoldPosition, InfoCowboyCount, InfoCowboyTeam, InfoCowboyPosition,
+    InfoBulletCount, InfoBulletTeam, InfoBulletPosition,
+    ModifyPosition, TransformPositionX, TransformPositionY, TransformXYPosition, CountDistance, GetDirection,
+    ComputeDistance, ComputeFirstStep,
+    VariablesGet, VariablesSet, MathChange,
+    LogicBoolean, ConstantDirection, LogicCompare, LogicOperation, LogicNegate,
+    MathNumber, MathAbs, MathArithmeticCustom, Constant,
+    MoveDirection, BulletFly, BulletLeft, BulletRight, FireDirection, MoveDirectionByNumber, FireDirectionByNumber,
+    ControlsRepeatExt, ControlsFor, ControlsIf,
+)
+from .profiler import ProfiledBlock, measure
+
+Compiled = Callable[[Run], Any]
+
+
+class Stop:
+    """Returned by a compiled statement to end its chain without any result
+    (`ControlsFor` with zero step does not continue with its `next`)."""
+
+    def __repr__(self) -> str:
+        return "STOP"
+
+
+STOP = Stop()
+
+compilers: dict[Type[Block], Callable[[Any], Compiled]] = {}
+statement_compilers: dict[Type[Block], Callable[[Any], Compiled]] = {}
+
+
+def compiles(*block_types: Type[Block]):
+    def decorator(f):
+        for block_type in block_types:
+            compilers[block_type] = f
+        return f
+    return decorator
+
+
+def compiles_statement(*block_types: Type[Block]):
+    def decorator(f):
+        for block_type in block_types:
+            statement_compilers[block_type] = f
+        return f
+    return decorator
+
+
+def compile_block(block: Block) -> Compiled:
+    """Compiles a block which ends the chain (value or action block)."""
+    if type(block) is ProfiledBlock:
+        return measure(block, compile_block(block.block))
+    compiler = compilers.get(type(block))
+    if compiler is None:
+        # Unknown block, keep interpreting the tree
+        return block.execute
+    return compiler(block)
+
+
+def compile_chain(block: Block | None) -> Compiled:
+    """Compiles a chain of blocks linked by `next`. The compiled function
+    returns the result of the chain (action or None)."""
+    statements: list[Compiled] = []
+    while block is not None and _is_statement(block):
+        statements.append(_compile_statement(block))
+        block = block.next
+    last = compile_block(block) if block is not None else None
+
+    if len(statements) == 0:
+        return last or _empty_chain
+
+    if last is None:
+        def chain(run: Run) -> Any:
+            for statement in statements:
+                ret = statement(run)
+                if ret is not None:
+                    return None if ret is STOP else ret
+            return None
+    else:
+        def chain(run: Run) -> Any:
+            for statement in statements:
+                ret = statement(run)
+                if ret is not None:
+                    return None if ret is STOP else ret
+            return last(run)
+    return chain
+
+
+def _is_statement(block: Block) -> bool:
+    if type(block) is ProfiledBlock:
+        block = block.block
+    return type(block) in statement_compilers
+
+
+def _compile_statement(block: Block) -> Compiled:
+    if type(block) is ProfiledBlock:
+        return measure(block, _compile_statement(block.block))
+    return statement_compilers[type(block)](block)
+
+
+def _empty_chain(run: Run) -> None:
+    return None
+
+
+def _field_value(field: Field) -> Any:
+    assert isinstance(field, StaticField)
+    return field.value
+
+
+################################################################################
+# Game info
+
+@compiles(InfoTeam)
+def _info_team(block: InfoTeam) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.context.team
+    return f
+
+
+@compiles(InfoPoints)
+def _info_points(block: InfoPoints) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.map.my_points(run.context)
+    return f
+
+
+@compiles(InfoIndex)
+def _info_index(block: InfoIndex) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.context.index  # type: ignore
+    return f
+
+
+@compiles(InfoID)
+def _info_id(block: InfoID) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.map.my_id(run.context)
+    return f
+
+
+@compiles(InfoMyDirection)
+def _info_my_direction(block: InfoMyDirection) -> Compiled:
+    from .map import Bullet
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        assert isinstance(run.context, Bullet)
+        return run.context.direction
+    return f
+
+
+@compiles(InfoMyRange)
+def _info_my_range(block: InfoMyRange) -> Compiled:
+    from .map import Bullet
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        assert isinstance(run.context, Bullet)
+        return run.map.BULLET_LIFETIME - run.context.turns_made
+    return f
+
+
+@compiles(InfoTurn)
+def _info_turn(block: InfoTurn) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.map.turn_idx
+    return f
+
+
+@compiles(InfoMyPosition)
+def _info_my_position(block: InfoMyPosition) -> Compiled:
+    def f(run: Run) -> Any:
+        run.add_steps(1)
+        return run.map.my_position(run.context)
+    return f
+
+
+@compiles(InfoMapPosition)
+def _info_map_position(block: InfoMapPosition) -> Compiled:
+    position = compile_block(block.position)
+    grid_name = {
+        "WALL": "wall_grid",
+        "GOLD": "gold_grid",
+        "COWBOY": "cowboy_grid",
+        "BULLET": "bullet_grid",
+    }.get(_field_value(block.entity))
+
+    if grid_name is None:
+        def f(run: Run) -> bool:
+            run.add_steps(1)
+            (c, r) = position(run)
+            return False  # should not happen
+    elif grid_name == "wall_grid":
+        def f(run: Run) -> bool:
+            run.add_steps(1)
+            (c, r) = position(run)
+            return run.map.wall_grid[r][c]
+    else:
+        get_grid = operator.attrgetter(grid_name)
+
+        def f(run: Run) -> bool:
+            run.add_steps(1)
+            (c, r) = position(run)
+            return get_grid(run.map)[r][c] is not None
+    return f
+
+
+@compiles(InfoGoldCount)
+def _info_gold_count(block: InfoGoldCount) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.map.number_of_golds()
+    return f
+
+
+@compiles(InfoCowboyCount)
+def _info_cowboy_count(block: InfoCowboyCount) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.map.number_of_cowboys()
+    return f
+
+
+@compiles(InfoBulletCount)
+def _info_bullet_count(block: InfoBulletCount) -> Compiled:
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return run.map.number_of_bullets()
+    return f
+
+
+def _indexed_query(child: Block, query_name: str) -> Compiled:
+    index = compile_block(child)
+
+    def f(run: Run) -> Any:
+        run.add_steps(1)
+        i = index(run)
+        assert isinstance(i, int)
+        return getattr(run.map, query_name)(i)  # the map may override the query
+    return f
+
+
+@compiles(InfoGoldPosition)
+def _info_gold_position(block: InfoGoldPosition) -> Compiled:
+    return _indexed_query(block.gold_block, "gold_i_position")
+
+
+@compiles(InfoCowboyTeam)
+def _info_cowboy_team(block: InfoCowboyTeam) -> Compiled:
+    return _indexed_query(block.cowboy_block, "cowboy_i_team")
+
+
+@compiles(InfoCowboyPosition)
+def _info_cowboy_position(block: InfoCowboyPosition) -> Compiled:
+    return _indexed_query(block.cowboy_block, "cowboy_i_position")
+
+
+@compiles(InfoBulletTeam)
+def _info_bullet_team(block: InfoBulletTeam) -> Compiled:
+    return _indexed_query(block.bullet_block, "bullet_i_team")
+
+
+@compiles(InfoBulletPosition)
+def _info_bullet_position(block: InfoBulletPosition) -> Compiled:
+    return _indexed_query(block.bullet_block, "bullet_i_position")
+
+
+################################################################################
+# Positions
+
+@compiles(ModifyPosition)
+def _modify_position(block: ModifyPosition) -> Compiled:
+    position = compile_block(block.position)
+    direction = compile_block(block.direction)
+    deltas = [d.value for d in all_directions]
+
+    def f(run: Run) -> Any:
+        run.add_steps(1)
+        (x, y) = position(run)
+        dir = direction(run)
+        assert type(dir) is int
+        (dx, dy) = deltas[dir % 8]
+        return ((x + dx) % run.map.width, (y + dy) % run.map.height)
+    return f
+
+
+@compiles(TransformPositionX)
+def _transform_position_x(block: TransformPositionX) -> Compiled:
+    position = compile_block(block.block_position)
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return position(run)[0]
+    return f
+
+
+@compiles(TransformPositionY)
+def _transform_position_y(block: TransformPositionY) -> Compiled:
+    position = compile_block(block.block_position)
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return position(run)[1]
+    return f
+
+
+@compiles(TransformXYPosition)
+def _transform_x_y_position(block: TransformXYPosition) -> Compiled:
+    block_x = compile_block(block.block_x)
+    block_y = compile_block(block.block_y)
+
+    def f(run: Run) -> Any:
+        run.add_steps(1)
+        x = block_x(run)
+        y = block_y(run)
+        assert isinstance(x, int) and isinstance(y, int)
+        return (x, y)
+    return f
+
+
+@compiles(CountDistance)
+def _count_distance(block: CountDistance) -> Compiled:
+    position = compile_block(block.block_position)
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        pos = position(run)
+        assert run.context.position is not None
+        return run.map.maximum_metric(run.context.position, pos)
+    return f
+
+
+_direction_indices = {d.value: i for i, d in enumerate(bullet_directions)}
+
+
+def direction_towards(width: int, height: int, position: tuple[int, int], target: tuple[int, int]) -> int:
+    """Index of the best direction from `position` to `target` (of `bullet_directions`)
+    for `GetDirection`, the same in all engines. Walls are not taken into account."""
+    x, y = position
+    tx, ty = target
+    dx, dy = (tx - x, ty - y)
+
+    # Wrap over the edge of the map
+    if dx > width/2:
+        dx -= width
+    elif dx < -width/2:
+        dx += width
+
+    if dy > height/2:
+        dy -= height
+    elif dy < -height/2:
+        dy += height
+
+    out_x, out_y = 0, 0
+    # if difference in one axis is more than twice the difference in the
+    # other axis -> move only in one axis
+    if abs(dy) <= 2*abs(dx):
+        out_x = 1 if dx > 0 else -1
+    if abs(dx) <= 2*abs(dy):
+        out_y = 1 if dy > 0 else -1
+
+    i = _direction_indices.get((out_x, out_y))
+    if i is None:
+        print(f"ERROR in ComputeDirection: {(out_x, out_y)} not found")
+        return -1  # Should not happen
+    return i
+
+
+@compiles(GetDirection)
+def _get_direction(block: GetDirection) -> Compiled:
+    position = compile_block(block.pos)
+
+    def f(run: Run) -> int:
+        target = position(run)
+        run.add_steps(1)
+        assert run.context.position is not None
+        return direction_towards(run.map.width, run.map.height, run.context.position, target)
+    return f
+
+
+@compiles(ComputeDistance)
+def _compute_distance(block: ComputeDistance) -> Compiled:
+    from .map import Cowboy
+    position = compile_block(block.pos)
+
+    def f(run: Run) -> int:
+        pos = position(run)
+        run.add_steps(1)
+        assert isinstance(run.context, Cowboy)
+        return run.query("distance_from", run.context, pos)
+    return f
+
+
+@compiles(ComputeFirstStep)
+def _compute_first_step(block: ComputeFirstStep) -> Compiled:
+    from .map import Cowboy
+    position = compile_block(block.pos)
+    indices = {d.value: i for i, d in enumerate(all_directions)}
+
+    def f(run: Run) -> int:
+        pos = position(run)
+        run.add_steps(1)
+        assert isinstance(run.context, Cowboy)
+        return indices.get(run.query("which_way", run.context, pos), -1)
+    return f
+
+
+################################################################################
+# Variables
+
+@compiles(VariablesGet)
+def _variables_get(block: VariablesGet) -> Compiled:
+    name = block.var.name
+    slot = block.var.slot
+
+    def f(run: Run) -> Any:
+        run.add_steps(1)
+        value = run.variables[slot]
+        if value is UNSET:
+            raise KeyError(name)
+        return value
+    return f
+
+
+@compiles_statement(VariablesSet)
+def _variables_set(block: VariablesSet) -> Compiled:
+    slot = block.var.slot
+    value = compile_block(block.value)
+
+    def f(run: Run) -> None:
+        run.add_steps(1)
+        ret = value(run)
+        assert ret is not None and not isinstance(ret, Action)
+        run.variables[slot] = ret
+    return f
+
+
+@compiles_statement(MathChange)
+def _math_change(block: MathChange) -> Compiled:
+    slot = block.var.slot
+    delta = compile_block(block.delta)
+
+    def f(run: Run) -> None:
+        run.add_steps(1)
+        d = delta(run)
+        assert isinstance(d, int)
+        run.variables[slot] += d  # type: ignore
+    return f
+
+
+################################################################################
+# Logic and math
+
+@compiles(LogicBoolean)
+def _logic_boolean(block: LogicBoolean) -> Compiled:
+    value = _field_value(block.field)
+
+    def f(run: Run) -> bool:
+        run.add_steps(1)
+        assert isinstance(value, bool)
+        return value
+    return f
+
+
+@compiles(ConstantDirection)
+def _constant_direction(block: ConstantDirection) -> Compiled:
+    raw_value = _field_value(block.direction)
+    try:
+        value = int(raw_value)
+    except ValueError as e:
+        error = e
+
+        def f(run: Run) -> int:
+            run.add_steps(1)
+            raise error
+        return f
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        return value
+    return f
+
+
+@compiles(MathNumber)
+def _math_number(block: MathNumber) -> Compiled:
+    value = _field_value(block.field)
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        assert isinstance(value, int)
+        return value
+    return f
+
+
+@compiles(LogicCompare)
+def _logic_compare(block: LogicCompare) -> Compiled:
+    op = block.operation
+    block_A = compile_block(block.block_A)
+    block_B = compile_block(block.block_B)
+
+    def f(run: Run) -> bool:
+        run.add_steps(1)
+        return op(block_A(run), block_B(run))
+    return f
+
+
+@compiles(LogicOperation)
+def _logic_operation(block: LogicOperation) -> Compiled:
+    combine = block.operation
+    block_A = compile_block(block.block_A)
+    block_B = compile_block(block.block_B)
+
+    def f(run: Run) -> bool:
+        run.add_steps(1)
+        A = block_A(run)
+        B = block_B(run)
+        assert isinstance(A, bool) and isinstance(B, bool)
+        return combine(A, B)
+    return f
+
+
+@compiles(LogicNegate)
+def _logic_negate(block: LogicNegate) -> Compiled:
+    child = compile_block(block.bool_child)
+
+    def f(run: Run) -> bool:
+        run.add_steps(1)
+        return not child(run)
+    return f
+
+
+@compiles(MathAbs)
+def _math_abs(block: MathAbs) -> Compiled:
+    number = compile_block(block.number)  # type: ignore
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        ret = number(run)
+        assert isinstance(ret, int)
+        return abs(ret)
+    return f
+
+
+@compiles(MathArithmeticCustom)
+def _math_arithmetic_custom(block: MathArithmeticCustom) -> Compiled:
+    op = block.operation
+    block_A = compile_block(block.block_A)
+    block_B = compile_block(block.block_B)
+
+    def f(run: Run) -> int:
+        run.add_steps(1)
+        A = block_A(run)
+        B = block_B(run)
+        assert isinstance(A, int) and isinstance(B, int)
+        return op(A, B)
+    return f
+
+
+@compiles(Constant)
+def _constant(block: Constant) -> Compiled:
+    value = block.value
+    steps = block.steps
+
+    def f(run: Run) -> Any:
+        run.add_steps(steps)
+        return value
+    return f
+
+
+################################################################################
+# Actions (actions are never modified, so they could be shared by all runs)
+
+def _constant_action(action: Action) -> Compiled:
+    def f(run: Run) -> Action:
+        return action
+    return f
+
+
+@compiles(Nop, BulletFly)
+def _nop(block: Block) -> Compiled:
+    return _constant_action(Action(ActionType.NOP))
+
+
+@compiles(BulletLeft)
+def _bullet_left(block: BulletLeft) -> Compiled:
+    return _constant_action(Action(ActionType.BULLET_TURN_L))
+
+
+@compiles(BulletRight)
+def _bullet_right(block: BulletRight) -> Compiled:
+    return _constant_action(Action(ActionType.BULLET_TURN_R))
+
+
+def _direction_action(action_type: ActionType, directions: list, name: Any) -> Compiled:
+    action = Action(ActionType.NOP)  # should not happen
+    for d in directions:
+        if d.name == name:
+            action = Action(action_type, d)
+            break
+
+    def f(run: Run) -> Action:
+        run.add_steps(1)
+        return action
+    return f
+
+
+@compiles(MoveDirection)
+def _move_direction(block: MoveDirection) -> Compiled:
+    return _direction_action(ActionType.MOVE, cowboy_directions, _field_value(block.direction))
+
+
+@compiles(FireDirection)
+def _fire_direction(block: FireDirection) -> Compiled:
+    return _direction_action(ActionType.FIRE, bullet_directions, _field_value(block.direction))
+
+
+@compiles(MoveDirectionByNumber)
+def _move_direction_by_number(block: MoveDirectionByNumber) -> Compiled:
+    direction = compile_block(block.direction)
+    nop = Action(ActionType.NOP)
+    moves = [Action(ActionType.MOVE, cowboy_directions[i // 2]) for i in range(8)]
+
+    def f(run: Run) -> Action:
+        run.add_steps(1)
+        i = direction(run)
+        assert isinstance(i, int)
+        if i < 0:
+            return nop
+        return moves[i % 8]
+    return f
+
+
+@compiles(FireDirectionByNumber)
+def _fire_direction_by_number(block: FireDirectionByNumber) -> Compiled:
+    direction = compile_block(block.direction)  # type: ignore
+    nop = Action(ActionType.NOP)
+    fires = [Action(ActionType.FIRE, d) for d in bullet_directions]
+
+    def f(run: Run) -> Action:
+        run.add_steps(1)
+        i = direction(run)
+        assert isinstance(i, int)
+        if i < 0:
+            return nop
+        return fires[i % 8]
+    return f
+
+
+################################################################################
+# Control flow
+
+@compiles_statement(ControlsRepeatExt)
+def _controls_repeat_ext(block: ControlsRepeatExt) -> Compiled:
+    times = compile_block(block.times)
+    do = compile_chain(block.do)
+
+    def f(run: Run) -> Any:
+        n = times(run)
+        assert isinstance(n, int)
+        for _ in range(n):
+            run.add_steps(1)
+            ret = do(run)
+            if ret is not None:
+                return ret
+        return None
+    return f
+
+
+@compiles_statement(ControlsFor)
+def _controls_for(block: ControlsFor) -> Compiled:
+    slot = block.var.slot
+    block_from = compile_block(block.block_from)
+    block_to = compile_block(block.block_to)
+    block_by = compile_block(block.block_by)
+    do = compile_chain(block.do)
+
+    def f(run: Run) -> Any:
+        start = block_from(run)
+        to = block_to(run)
+        by = block_by(run)
+        assert isinstance(start, int) and isinstance(to, int) and isinstance(by, int)
+        if by == 0:
+            return STOP
+
+        variables = run.variables
+        for i in range(start, to, by):
+            run.add_steps(1)
+            variables[slot] = i
+            ret = do(run)
+            if ret is not None:
+                return ret
+        return None
+    return f
+
+
+@compiles_statement(ControlsIf)
+def _controls_if(block: ControlsIf) -> Compiled:
+    conditions = [(compile_block(condition), compile_chain(do)) for (condition, do) in block.conditions]
+    do_else = compile_chain(block.do_else) if block.do_else is not None else _empty_chain
+
+    def f(run: Run) -> Any:
+        run.add_steps(1)
+        for (condition, do) in conditions:
+            if condition(run) is True:
+                return do(run)
+        return do_else(run)
+    return f
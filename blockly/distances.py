@@ -0,0 +1,201 @@
+"""All-pairs distances and first steps of cowboys.
+
+Walls never change after they are generated, so the shortest paths between
+all pairs of squares can be computed once at the start of the game. Then
+`GameMap.distance_from` and `GameMap.which_way` are just lookups instead of
+a BFS from the cowboy and a walk back from the goal.
+
+Squares are numbered `y * width + x`. Both tables are flat arrays indexed by
+`start * cells + goal`, `first_steps` holds indices into `moves`.
+
+The tables grow quadratically with the map, so they may be kept in a file
+named by a hash of the walls: the file is written once (row by row, without
+keeping the tables in memory) and then memory-mapped, which makes restarts
+instant and lets processes with the same walls share the pages.
+"""
+from __future__ import annotations
+from array import array
+from collections import OrderedDict
+import hashlib
+import mmap
+import os
+from typing import Callable, Iterator
+
+from .actions import cowboy_directions
+
+Coords = tuple[int, int]
+
+# Bump when the file layout or the computed paths change
+FILE_VERSION = 1
+
+
+def walls_hash(wall_grid: list[list[bool]]) -> str:
+    digest = hashlib.sha256(f"v{FILE_VERSION}:{len(wall_grid[0])}x{len(wall_grid)}:".encode())
+    digest.update(bytes(wall for row in wall_grid for wall in row))
+    return digest.hexdigest()
+
+
+class DistanceTable:
+    width: int
+    height: int
+    cells: int
+    infty: int  # distance of unreachable squares (and walls)
+    unreachable: int  # stored instead of `infty`, which may not fit into the typecode
+    typecode: str  # of `distances`
+    distances: array | memoryview
+    first_steps: bytearray | memoryview
+    moves: list[Coords]  # (0, 0) and the steps in `cowboy_directions`
+    path: str | None  # of the memory-mapped file
+
+    def __init__(self, wall_grid: list[list[bool]], infty: int, directory: str | None = None) -> None:
+        """Computes the tables, or maps them from the file for these walls in
+        `directory` (which is written first if it does not exist yet)."""
+        self.height = len(wall_grid)
+        self.width = len(wall_grid[0])
+        self.cells = self.width * self.height
+        self.infty = infty
+        self.typecode = "H" if self.cells < 0xFFFF else "I"
+        self.unreachable = 0xFFFF if self.typecode == "H" else 0xFFFFFFFF
+        self.moves = [(0, 0)] + [d.value for d in cowboy_directions]
+        self.path = None
+
+        if directory is None:
+            self.distances = array(self.typecode)
+            self.first_steps = bytearray()
+            for dist, first in self._rows(wall_grid):
+                self.distances.extend(dist)
+                self.first_steps.extend(first)
+        else:
+            self.path = os.path.join(directory, f"distances_{walls_hash(wall_grid)[:16]}.bin")
+            if not self._file_valid():
+                self._write(wall_grid, directory)
+            self._map()
+
+    def _file_size(self) -> int:
+        return self.cells * self.cells * (array(self.typecode).itemsize + 1)
+
+    def _file_valid(self) -> bool:
+        assert self.path is not None
+        return os.path.exists(self.path) and os.path.getsize(self.path) == self._file_size()
+
+    def _write(self, wall_grid: list[list[bool]], directory: str) -> None:
+        assert self.path is not None
+        os.makedirs(directory, exist_ok=True)
+        # Other processes may be mapping the same file, it must appear at once
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        split = self.cells * self.cells * array(self.typecode).itemsize
+        with open(tmp_path, "wb") as f:
+            f.truncate(self._file_size())
+            for start, (dist, first) in enumerate(self._rows(wall_grid)):
+                f.seek(start * self.cells * dist.itemsize)
+                dist.tofile(f)
+                f.seek(split + start * self.cells)
+                f.write(first)
+        os.replace(tmp_path, self.path)
+
+    def _map(self) -> None:
+        assert self.path is not None
+        with open(self.path, "rb") as f:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        split = self.cells * self.cells * array(self.typecode).itemsize
+        self.distances = data[:split].cast(self.typecode)
+        self.first_steps = data[split:]
+
+    def _neighbours(self, i: int) -> list[tuple[int, int]]:
+        """(square, index into `moves` of the step back to `i`) for the
+        squares around `i`, in the order of `cowboy_directions`."""
+        x, y = i % self.width, i // self.width
+        out = []
+        for d in cowboy_directions:
+            new_x, new_y = (x + d.value[0]) % self.width, (y + d.value[1]) % self.height
+            back = self.moves.index((-d.value[0], -d.value[1]))
+            out.append((new_y * self.width + new_x, back))
+        return out
+
+    def _rows(self, wall_grid: list[list[bool]]) -> Iterator[tuple[array, bytearray]]:
+        """Yields distances and first steps from each square in turn."""
+        walls = [wall for row in wall_grid for wall in row]
+        neighbours = [self._neighbours(i) for i in range(self.cells)]
+        for start in range(self.cells):
+            if walls[start]:
+                yield array(self.typecode, [self.unreachable]) * self.cells, bytearray(self.cells)
+            else:
+                yield self._row(start, walls, neighbours)
+
+    def _row(self, start: int, walls: list[bool], neighbours: list[list[tuple[int, int]]]) -> tuple[array, bytearray]:
+        unreachable = self.unreachable
+        dist = [unreachable] * self.cells
+        dist[start] = 0
+        order = [start]
+        for i in order:  # BFS, `order` grows while iterating
+            for j, _ in neighbours[i]:
+                if dist[j] == unreachable and not walls[j]:
+                    dist[j] = dist[i] + 1
+                    order.append(j)
+
+        # Same path as the walk back from the goal in `GameMap.which_way`
+        # takes: to the first neighbour which is closer to the start.
+        # Unreachable squares and walls come last, they have the largest distance.
+        reached = set(order)
+        order += [i for i in range(self.cells) if i not in reached]
+        first = bytearray(self.cells)
+        for i in order[1:]:
+            for j, back in neighbours[i]:
+                if dist[j] < dist[i]:
+                    first[i] = back if j == start else first[j]
+                    break
+
+        return array(self.typecode, dist), first
+
+    def distance(self, start: Coords, goal: Coords) -> int:
+        d = self.distances[(start[1] * self.width + start[0]) * self.cells + goal[1] * self.width + goal[0]]
+        return self.infty if d == self.unreachable else d
+
+    def first_step(self, start: Coords, goal: Coords) -> Coords:
+        """Step from `start` towards `goal`, (0, 0) if there is none."""
+        index = (start[1] * self.width + start[0]) * self.cells + goal[1] * self.width + goal[0]
+        return self.moves[self.first_steps[index]]
+
+
+class DistanceCache:
+    """Distances from cowboy positions computed by BFS, flattened into arrays
+    indexed by `y * width + x`. At most `capacity` positions are kept, the
+    least recently used one is evicted first."""
+    capacity: int
+    typecode: str  # of the arrays, large enough for `infty`
+    hits: int
+    misses: int
+    evictions: int
+    _entries: OrderedDict[Coords, array]
+
+    def __init__(self, capacity: int, infty: int) -> None:
+        self.capacity = capacity
+        self.typecode = "H" if infty <= 0xFFFF else "I"
+        self._entries = OrderedDict()
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, position: Coords) -> bool:
+        return position in self._entries
+
+    def get(self, position: Coords, compute: Callable[[], list[int]]) -> array:
+        """Distances from `position`, computed by `compute` if not cached."""
+        distances = self._entries.get(position)
+        if distances is not None:
+            self.hits += 1
+            self._entries.move_to_end(position)
+            return distances
+
+        self.misses += 1
+        distances = self._entries[position] = array(self.typecode, compute())
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return distances
@@ -2,20 +2,36 @@
 # import os
 import glob
 import json
+import multiprocessing
+import multiprocessing.pool
+import weakref
 from random import randrange as rr
 from random import shuffle
+from bisect import bisect_left
 import queue
 from collections import deque
 import time
-from typing import Any, Callable
+from typing import Any, Callable, Sequence
 
 from .team import Team
+from .program import Program
+from .profiler import Profile
+from .distances import DistanceCache, DistanceTable
+from .bfs import GridBFS
+from .squares import SquareSet
+from .ranked import RankedList
 from .actions import Action, ActionType, Direction, all_directions, cowboy_directions, bullet_directions
 
 Coords = tuple[int, int]
 
+# Keys of what cowboy programs read and actions change (see `parallel.py`)
+COWBOY_ORDER = "cowboy_order"
+GOLDS = "golds"
+BULLETS = "bullets"
+
 
 class Context:
+    __slots__ = ("team", "position")
     # Changes every turn
     team: int
     index: int
@@ -24,6 +40,8 @@ class Context:
 
 
 class Cowboy(Context):
+    __slots__ = ("index",)
+
     def __init__(self, team: int, index: int, position: Coords | None):
         self.team = team
         self.index = index
@@ -35,6 +53,8 @@ class Cowboy(Context):
 
 
 class Bullet(Context):
+    __slots__ = ("direction", "turns_made")
+
     # `direction` is an index for bullet_directions
     def __init__(self, team: int, position: Coords, direction: int, turns_made: int = 0):
         self.team = team
@@ -48,8 +68,12 @@ class Bullet(Context):
 
 
 class Gold:
+    __slots__ = ("position",)
     position: Coords | None
 
+    def __init__(self) -> None:
+        self.position = None
+
 
 class TeamStats:
     points: int
@@ -72,6 +96,10 @@ class TeamStats:
 class GameMap:
     save_dir: str
     wall_grid: list[list[bool]]
+    wall_squares: list[bool]  # `wall_grid` flattened, indexed by `y * width + x`
+    # Squares without wall, cowboy, bullet and gold, kept in sync with the
+    # grids by `update_free_square` (call it after changing a grid)
+    free_squares: SquareSet
     cowboy_grid: list[list[Cowboy | None]]
     bullet_grid: list[list[Bullet | None]]
     gold_grid: list[list[Gold | None]]
@@ -79,20 +107,47 @@ class GameMap:
     team_stats: list[TeamStats]
 
     gold_list: list[Gold]
+    # Positions of the golds on the map in the order of `gold_list` and
+    # their indices in `gold_list`, kept by `update_live_gold`
+    live_gold_positions: list[Coords]
+    live_gold_indices: list[int]
+    gold_indices: dict[Gold, int]
     cowboy_list: list[Cowboy]
-    bullet_list: list[Bullet]
+    # Removed bullets / cowboys leave tombstones until the end of the turn,
+    # indices (`my_id`, `bullet_i`, `cowboy_i`) skip them
+    bullet_list: RankedList[Bullet]
 
     cowboy_spawn_deque: deque[tuple[int, Cowboy]]
 
+    # Processes running cowboy programs in parallel (None if they run one by one)
+    parallel_workers: int
+    pool: multiprocessing.pool.Pool | None
+    pool_finalizer: weakref.finalize | None
+    # Cowboy programs run in parallel and how many of their results were used
+    speculative_runs: int
+    speculative_reused: int
+    # Keys of what the actions changed in this turn, recorded by `wrote`
+    # when the programs were run in parallel (None otherwise)
+    written: set[Any] | None
+
     # has value only during turn computation
-    active_cowboys: list[Cowboy]
+    active_cowboys: RankedList[Cowboy]
 
     current_explosions: list[Coords]
     current_gun_triggers: list[tuple[int, int, int]]
 
+    # Searches of the map in cowboy / bullet directions
+    cowboy_bfs: GridBFS
+    bullet_bfs: GridBFS
+
     # At each cowboy turn, once we compute a cowboy's BFS, we cache
-    # the distances.
-    cached_distances: dict[Coords, list[list[int]]]
+    # the distances (of at most DISTANCE_CACHE_SIZE positions).
+    cached_distances: DistanceCache
+    # `which_way` results by (start, goal) shared by all cowboys in the turn
+    first_steps: dict[tuple[Coords, Coords], Coords]
+    # Distances and first steps between all squares, computed at the start
+    # when `precompute_distances` is set (then the two caches above are unused)
+    distance_table: DistanceTable | None
 
     # Results of actions (not saved into JSON)
     # (list of rounds, for each round a list of teams)
@@ -102,6 +157,13 @@ class GameMap:
     a_star_time: float
     bfs_time: float
 
+    # Whether programs are profiled per block (slower)
+    profiling: bool
+    # Profiles of programs of each team from the last cowboy / bullet turn
+    # (None if the team had nothing to run or profiling was off)
+    cowboy_profiles: list[Profile | None]
+    bullet_profiles: list[Profile | None]
+
     # Only counts cowboy turns
     turn_idx: int
     # count bullet turns, reset with each turn_idx increase
@@ -120,6 +182,10 @@ class GameMap:
     # Maximum program lengths:
     COWBOY_MAX_STEPS = 6000
     BULLET_MAX_STEPS = 2000
+    # Positions whose BFS distances are kept (about 2 B per square each)
+    DISTANCE_CACHE_SIZE = 1000
+    # Wall clusters left out in a row after which no more are tried
+    MAX_WALL_REJECTIONS = 100
 
     all_rounds: list[dict]
 
@@ -134,18 +200,33 @@ class GameMap:
             load_saves: bool = False,
             save_dir: str = "save",
             wall_fraction: int = 50,
-            cluster_max: int = 5):
+            cluster_max: int = 5,
+            precompute_distances: bool = False,
+            # Processes running cowboy programs in parallel, 0 runs them one by one
+            parallel_workers: int = 0):
         self.width, self.height = width, height
         self.infty = 2 * self.width * self.height
+        self.init_bfs()
         self.teams = teams
         self.cowboys_per_team = cowboys_per_team
         self.gold_count = gold_count
 
-        self.cached_distances = {}
+        self.cached_distances = DistanceCache(self.DISTANCE_CACHE_SIZE, self.infty)
+        self.first_steps = {}
         self.cowboy_results = []
         self.bullet_results = []
 
+        self.profiling = False
+        self.cowboy_profiles = [None for _ in teams]
+        self.bullet_profiles = [None for _ in teams]
+
         self.save_dir = save_dir
+        self.written = None
+        self.parallel_workers = parallel_workers
+        self.pool = None
+        self.pool_finalizer = None
+        self.speculative_runs = 0
+        self.speculative_reused = 0
 
         save_files = sorted(glob.glob(f"{save_dir}/save_*.json"))
         if load_saves and len(save_files) > 0:
@@ -160,6 +241,30 @@ class GameMap:
             self.all_rounds = []
             print("Game initialization done")
 
+        self.distance_table = None
+        if precompute_distances:
+            self.distance_table = DistanceTable(self.wall_grid, self.infty, save_dir)
+            print(f"Distances between all squares mapped from '{self.distance_table.path}'")
+
+        if parallel_workers > 0:
+            # Forked now, before the web server starts its threads
+            self.start_pool()
+
+    # Forks `parallel_workers` processes for `run_cowboys_in_parallel`, which
+    # inherit the walls (they do not change during the game). The processes
+    # are terminated by `close` or when the map is garbage collected.
+    def start_pool(self) -> None:
+        from .parallel import SnapshotMap, init_worker
+        context = multiprocessing.get_context("fork")
+        self.pool = context.Pool(self.parallel_workers, initializer=init_worker, initargs=(SnapshotMap(self),))
+        self.pool_finalizer = weakref.finalize(self, self.pool.terminate)
+
+    def close(self) -> None:
+        if self.pool_finalizer is not None:
+            self.pool_finalizer()
+        self.pool = None
+        self.pool_finalizer = None
+
     def init_new(self, wall_fraction: int = 50, cluster_max: int = 5):
         self.team_stats = [TeamStats([0 for _ in range(len(self.teams))]) for _ in range(len(self.teams))]
 
@@ -171,13 +276,15 @@ class GameMap:
 
         self.cowboy_list = []
         self.gold_list = [Gold() for _ in range(self.gold_count)]
-        self.bullet_list = []
+        self.init_live_golds()
+        self.bullet_list = RankedList()
         self.current_explosions = []
         self.current_gun_triggers = []
         # Deque keeping track of when dead cowboys should respawn
         self.cowboy_spawn_deque = deque()
 
         self.generate_walls(wall_fraction, cluster_max)
+        self.init_free_squares()
         self.generate_cowboy_positions()
         self.generate_gold_positions()
 
@@ -369,9 +476,14 @@ class GameMap:
 
                 self.all_rounds.append(data)
 
+    def init_bfs(self) -> None:
+        self.cowboy_bfs = GridBFS(self.width, self.height, cowboy_directions)
+        self.bullet_bfs = GridBFS(self.width, self.height, bullet_directions)
+
     def load(self, data: dict) -> None:
         self.width = data["width"]
         self.height = data["height"]
+        self.init_bfs()
         self.turn_idx = data["turn_idx"]
         self.bullet_subturn = data["bullet_subturn"]
 
@@ -401,10 +513,12 @@ class GameMap:
         self.cowboy_grid = [[None for _ in range(self.width)] for _ in range(self.height)]
         self.cowboy_list = []
         self.bullet_grid = [[None for _ in range(self.width)] for _ in range(self.height)]
-        self.bullet_list = []
+        self.bullet_list = RankedList()
 
         for (c, r) in data['walls']:
             self.wall_grid[r][c] = True
+        self.wall_squares = [wall for row in self.wall_grid for wall in row]
+        self.init_free_squares()
 
         # Golds:
         for (c, r) in data['golds']:
@@ -414,11 +528,12 @@ class GameMap:
             if len(self.gold_list) < self.gold_count:
                 self.gold_list.append(gold)
                 self.gold_grid[r][c] = gold
+                self.update_free_square(c, r)
         # Fix gold count 2/2 (when new golds added)
-        while len(self.gold_list) < self.gold_count:
-            gold = Gold()
-            self.gold_list.append(gold)
-            self.spawn_gold(gold)
+        new_golds = [Gold() for _ in range(self.gold_count - len(self.gold_list))]
+        self.gold_list += new_golds
+        self.init_live_golds()
+        self.spawn_golds(new_golds)
 
         # Cowboys:
         team_counts = [0 for _ in range(len(self.teams))]
@@ -435,6 +550,7 @@ class GameMap:
                 if pos is not None:
                     c, r = pos
                     self.cowboy_grid[r][c] = cowboy
+                    self.update_free_square(c, r)
         # Fix cowboy count 2/2 (when new cowboys added)
         for i, count in enumerate(team_counts):
             while count < self.cowboys_per_team:
@@ -443,6 +559,7 @@ class GameMap:
                 count += 1
                 self.cowboy_list.append(cowboy)
                 self.cowboy_grid[pos[1]][pos[0]] = cowboy
+                self.update_free_square(*pos)
 
         # Respawn queue:
         self.cowboy_spawn_deque = deque()
@@ -456,153 +573,203 @@ class GameMap:
             self.bullet_list.append(bullet)
             c, r = pos
             self.bullet_grid[r][c] = bullet
+            self.update_free_square(c, r)
 
     # `(width * height) // wall_fraction` wall clusters will be generated
     # randomly in the grid, with at most `cluster_max` wall squares each.
+    # A cluster which would split the free squares (or cover all of them) is
+    # left out and another one is tried instead, so the walls are always
+    # valid after one pass. After `MAX_WALL_REJECTIONS` clusters left out in
+    # a row the map is considered full, it may end up with fewer clusters.
+    # A cluster which splits the free squares only until a later cluster
+    # fills the cut off part is left out too (a check of the whole map would
+    # accept it), so the same random seed may give other walls than the
+    # check of the finished map did.
     def generate_walls(self, wall_fraction: int = 50, cluster_max: int = 5) -> None:
-        self.wall_grid = [[False for _ in range(self.width)] for _ in range(self.height)]
-
-        for _ in range((self.width * self.height) // wall_fraction):
-            x, y = rr(self.width), rr(self.height)
-            d = rr(4)
-            for i in range(cluster_max):
-                dirchange = rr(6)
-                if dirchange == 0:
-                    d = (d + 1) % 4
-                elif dirchange == 1:
-                    d = (d + 3) % 4
-                dx, dy = cowboy_directions[d].value[0], cowboy_directions[d].value[1]
-                x, y = (x + dx) % self.width, (y + dy) % self.height
-                self.wall_grid[y][x] = True
-
-                if rr(cluster_max - i) == 0:
-                    break
-
-        if not self.check_walls():
-            self.generate_walls()
-
-    # Returns True if there is only one connected component of reachable squares.
-    def check_walls(self) -> bool:
-        squares_visited = [[False for _ in range(self.width)] for _ in range(self.height)]
-        # Find a starting wall-free square, count the number of free squares.
-        self.free_square_count = 0
-        init_x, init_y = 0, 0
+        start_time = time.time()
+        self.wall_squares = [False] * (self.width * self.height)
+        clusters = (self.width * self.height) // wall_fraction
+        laid = attempts = rejected_in_row = 0
+        while laid < clusters and rejected_in_row < self.MAX_WALL_REJECTIONS:
+            attempts += 1
+            cluster = [s for s in dict.fromkeys(self.random_cluster(cluster_max)) if not self.wall_squares[s]]
+            if self.splits_free_squares(cluster):
+                rejected_in_row += 1
+                continue
+            rejected_in_row = 0
+            for s in cluster:
+                self.wall_squares[s] = True
+            laid += 1
+
+        self.wall_grid = [self.wall_squares[y * self.width:(y + 1) * self.width] for y in range(self.height)]
+        self.free_square_count = self.wall_squares.count(False)
+        elapsed = round(time.time() - start_time, 3)
+        print(f"Walls generated in {elapsed}s: {laid} of {clusters} clusters laid in {attempts} attempts, "
+              f"{self.free_square_count} free squares")
+
+    # Squares of a random wall cluster, starting next to a random square.
+    def random_cluster(self, cluster_max: int) -> list[int]:
+        squares = []
+        steps = [d.value for d in cowboy_directions]
+        x, y = rr(self.width), rr(self.height)
+        d = rr(4)
+        for i in range(cluster_max):
+            dirchange = rr(6)
+            if dirchange == 0:
+                d = (d + 1) % 4
+            elif dirchange == 1:
+                d = (d + 3) % 4
+            dx, dy = steps[d]
+            x, y = (x + dx) % self.width, (y + dy) % self.height
+            squares.append(y * self.width + x)
+
+            if rr(cluster_max - i) == 0:
+                break
+        return squares
+
+    # Returns True if the free squares would not stay connected (or there
+    # would be none) after turning free `squares` into walls. The free
+    # squares must be connected now, then it is enough to check that all
+    # free squares around the new walls still reach each other.
+    def splits_free_squares(self, squares: list[int]) -> bool:
+        if not squares:
+            return False
+        walls = self.wall_squares
+        for s in squares:
+            walls[s] = True
+        border = [j for s in squares for j in self.cowboy_bfs.neighbours[s] if not walls[j]]
+        splits = not border or not self.cowboy_bfs.connected(border, walls)
+        for s in squares:
+            walls[s] = False
+        return splits
+
+    def init_free_squares(self) -> None:
+        self.free_squares = SquareSet(self.width * self.height)
         for y in range(self.height):
             for x in range(self.width):
-                if not self.wall_grid[y][x]:
-                    self.free_square_count += 1
-                    init_x, init_y = x, y
-        if self.free_square_count == 0:
-            return False
+                self.update_free_square(x, y)
 
-        # Check that as many are reachable from (init_x, init_y) as are free.
-        # BFS:
-        reached = 0
-        q: queue.Queue[Coords] = queue.Queue()
-        q.put((init_x, init_y))
-        while not q.empty():
-            x, y = q.get()
-            if squares_visited[y][x] or self.wall_grid[y][x]:
-                continue
-            squares_visited[y][x] = True
-            reached += 1
-            for d in cowboy_directions:
-                q.put(((x + d.value[0]) % self.width, (y + d.value[1]) % self.height))
+    def update_free_square(self, x: int, y: int) -> None:
+        if (not self.wall_grid[y][x] and self.cowboy_grid[y][x] is None
+                and self.bullet_grid[y][x] is None
+                and self.gold_grid[y][x] is None):
+            self.free_squares.add(y * self.width + x)
+        else:
+            self.free_squares.discard(y * self.width + x)
+        self.wrote(("cell", x, y))
+
+    def init_live_golds(self) -> None:
+        self.gold_indices = {gold: i for i, gold in enumerate(self.gold_list)}
+        self.live_gold_indices = [i for i, gold in enumerate(self.gold_list) if gold.position is not None]
+        self.live_gold_positions = [self.gold_list[i].position for i in self.live_gold_indices]
+
+    # Call after the gold is placed on the map or taken from it
+    def update_live_gold(self, gold: Gold) -> None:
+        self.wrote(GOLDS)
+        index = self.gold_indices[gold]
+        k = bisect_left(self.live_gold_indices, index)
+        live = k < len(self.live_gold_indices) and self.live_gold_indices[k] == index
+        if gold.position is None:
+            if live:
+                del self.live_gold_indices[k]
+                del self.live_gold_positions[k]
+        elif live:
+            self.live_gold_positions[k] = gold.position
+        else:
+            self.live_gold_indices.insert(k, index)
+            self.live_gold_positions.insert(k, gold.position)
 
-        return reached == self.free_square_count
+    # Records a change of what cowboy programs can read (see `parallel.py`)
+    def wrote(self, key: Any) -> None:
+        if self.written is not None:
+            self.written.add(key)
 
+    # Uniformly random square without wall, cowboy, bullet and gold
     def random_free_position(self) -> Coords:
-        pos = rr(self.width), rr(self.height)
-        seen = set()
-        q: queue.Queue[Coords] = queue.Queue()
-        q.put(pos)
-        while not q.empty():
-            x, y = q.get()
-            if (x, y) in seen:
-                continue
-            if (not self.wall_grid[y][x] and self.cowboy_grid[y][x] is None
-                    and self.bullet_grid[y][x] is None
-                    and self.gold_grid[y][x] is None):
-                return (x, y)
-            seen.add((x, y))
-            for d in bullet_directions:
-                new_pos = ((x + d.value[0]) % self.width, (y + d.value[1]) % self.height)
-                q.put(new_pos)
-        return (-1, -1)  # should not happen
+        if len(self.free_squares) == 0:
+            return (-1, -1)  # should not happen
+        square = self.free_squares.choice()
+        return (square % self.width, square // self.width)
 
     def generate_cowboy_positions(self) -> None:
-        # For each cowboy, generate a random spot and then place him at the nearest free square
+        # For each cowboy, generate a random free spot
         for i in range(len(self.teams)):
             for j in range(self.cowboys_per_team):
                 position = self.random_free_position()
                 cowboy = Cowboy(i, j, position)
                 self.cowboy_list.append(cowboy)
                 self.cowboy_grid[position[1]][position[0]] = cowboy
+                self.update_free_square(*position)
 
     def generate_gold_positions(self) -> None:
-        for g in self.gold_list:
-            self.spawn_gold(g)
+        self.spawn_golds(self.gold_list)
 
     # (Re)spawns a gold coin at a random spot, prefering squares far away from everything else.
     def spawn_gold(self, gold: Gold) -> None:
-        distances_from_objects = [[self.infty for _ in range(self.width)] for _ in range(self.height)]
-        bfs_queue: queue.Queue[tuple[int, Coords]] = queue.Queue()
-        for x in range(self.width):
-            for y in range(self.height):
-                if self.gold_grid[y][x] is not None or self.cowboy_grid[y][x]:
-                    bfs_queue.put((0, (x, y)))
-        distance_total = 0
-        while not bfs_queue.empty():
-            dist, (x, y) = bfs_queue.get()
-            if self.wall_grid[y][x] or distances_from_objects[y][x] < self.infty:
-                continue
-            distances_from_objects[y][x] = dist
-            distance_total += dist
-            for d in bullet_directions:
-                new_pos = ((x + d.value[0]) % self.width, (y + d.value[1]) % self.height)
-                bfs_queue.put((dist + 1, new_pos))
-
-        rand_choice = rr(distance_total)
-        for x in range(self.width):
-            for y in range(self.height):
-                if distances_from_objects[y][x] == self.infty:
+        self.spawn_golds([gold])
+
+    # Spawns the golds one by one, each as `spawn_gold` would (the golds
+    # placed before count as the other objects), but the distances from
+    # objects are computed only once and then updated after each gold.
+    def spawn_golds(self, golds: list[Gold]) -> None:
+        if not golds:
+            return
+        grid_bfs = self.bullet_bfs
+        objects = [
+            y * self.width + x
+            for y in range(self.height) for x in range(self.width)
+            if self.gold_grid[y][x] is not None or self.cowboy_grid[y][x]
+        ]
+        distances_from_objects = grid_bfs.distances(objects, self.wall_squares, self.infty)
+        distance_total = sum(d for d in distances_from_objects if d != self.infty)
+
+        for gold in golds:
+            rand_choice = rr(distance_total)
+            for square in grid_bfs.column_order:
+                dist = distances_from_objects[square]
+                if dist == self.infty:
                     continue
-                if distances_from_objects[y][x] > rand_choice:
-                    gold.position = (x, y)
-                    self.gold_grid[y][x] = gold
-                    return
-                rand_choice -= distances_from_objects[y][x]
+                if dist > rand_choice:
+                    break
+                rand_choice -= dist
+            else:
+                continue  # should not happen
+
+            x, y = grid_bfs.coords(square)
+            gold.position = (x, y)
+            self.update_live_gold(gold)
+            self.gold_grid[y][x] = gold
+            self.update_free_square(x, y)
+            distance_total += grid_bfs.add_source(distances_from_objects, square, self.wall_squares, self.infty)
 
     # Respawns a cowboy at (one of) the most distant square from everything else
     def spawn_cowboy(self, cowboy: Cowboy) -> None:
-        if cowboy.position is not None:
+        self.spawn_cowboys([cowboy])
+
+    # Spawns the cowboys one by one, each as `spawn_cowboy` would (the cowboys
+    # placed before count as the other objects), but the distances from
+    # objects are computed only once and then updated after each cowboy.
+    def spawn_cowboys(self, cowboys: list[Cowboy]) -> None:
+        cowboys = [c for c in cowboys if c.position is None]
+        if not cowboys:
             return
-        seen = [[False for _ in range(self.width)] for _ in range(self.height)]
-        bfs_queue: queue.Queue[tuple[int, Coords]] = queue.Queue()
-        for c in self.cowboy_list:
-            if c.position is not None:
-                bfs_queue.put((0, c.position))
-        for g in self.gold_list:
-            if g.position is not None:
-                bfs_queue.put((0, g.position))
-        dist_max = -1
-        max_list: list[Coords] = []
-        while not bfs_queue.empty():
-            dist, (x, y) = bfs_queue.get()
-            if self.wall_grid[y][x] or seen[y][x]:
-                continue
-            if dist > dist_max:
-                dist_max = dist
-                max_list = []
-            max_list.append((x, y))
-            seen[y][x] = True
-            for d in cowboy_directions:
-                new_pos = ((x + d.value[0]) % self.width, (y + d.value[1]) % self.height)
-                bfs_queue.put((dist + 1, new_pos))
-        x, y = max_list[rr(len(max_list))]
-        cowboy.position = (x, y)
-        print(f"GAME[INFO]: {cowboy} spawned after death")
-        self.cowboy_grid[y][x] = cowboy
+        grid_bfs = self.cowboy_bfs
+        objects = [c.position for c in self.cowboy_list if c.position is not None]
+        objects += [g.position for g in self.gold_list if g.position is not None]
+        distances = grid_bfs.distances(map(grid_bfs.square, objects), self.wall_squares, self.infty)
+
+        for cowboy in cowboys:
+            if cowboy.position is not None:
+                continue  # listed twice
+            dist_max = max((d for d in distances if d != self.infty), default=-1)
+            max_list = [square for square, d in enumerate(distances) if d == dist_max]
+            square = max_list[rr(len(max_list))]
+            x, y = grid_bfs.coords(square)
+            cowboy.position = (x, y)
+            print(f"GAME[INFO]: {cowboy} spawned after death")
+            self.cowboy_grid[y][x] = cowboy
+            self.update_free_square(x, y)
+            grid_bfs.add_source(distances, square, self.wall_squares, self.infty)
 
     def bullet_disappear(self, bullet: Bullet) -> None:
         if bullet.position is None:
@@ -610,7 +777,9 @@ class GameMap:
         x, y = bullet.position
         bullet.position = None
         self.bullet_list.remove(bullet)
+        self.wrote(BULLETS)
         self.bullet_grid[y][x] = None
+        self.update_free_square(x, y)
 
     def bullet_hit(self, cowboy: Cowboy, bullet: Bullet):
         if cowboy.position is None or cowboy.position != bullet.position:
@@ -620,11 +789,14 @@ class GameMap:
         self.team_stats[cowboy.team].deaths += 1
         if cowboy.team != bullet.team:
             self.team_stats[bullet.team].points += self.SHOTDOWN_BOUNTY
+            self.wrote(("points", bullet.team))
         x, y = cowboy.position
         self.bullet_disappear(bullet)
         self.cowboy_grid[y][x] = None
+        self.update_free_square(x, y)
         cowboy.position = None
         self.active_cowboys.remove(cowboy)
+        self.wrote(COWBOY_ORDER)
         self.cowboy_spawn_deque.append((self.turn_idx + self.TURNS_TO_RESPAWN, cowboy))
         self.current_explosions.append((x, y))
 
@@ -693,27 +865,31 @@ class GameMap:
         start_time = time.time()
         self.a_star_time = 0
         self.bfs_time = 0
+        self.cached_distances.reset_counters()
 
         self.current_explosions = []
         self.current_gun_triggers = []
+        self.first_steps = {}
         golds_to_respawn = []
         # If any cowboys ought to be respawned, do it.
+        cowboys_to_respawn = []
         while len(self.cowboy_spawn_deque) > 0:
             spawn_turn, cowboy = self.cowboy_spawn_deque.popleft()
             if spawn_turn > self.turn_idx:
                 self.cowboy_spawn_deque.appendleft((spawn_turn, cowboy))
                 break
-            self.spawn_cowboy(cowboy)
+            cowboys_to_respawn.append(cowboy)
+        self.spawn_cowboys(cowboys_to_respawn)
 
         # Generate a random shuffling of the cowboys.
-        self.active_cowboys = []
+        # make copy so that self.active_cowboys could be modified during the turn (when cowboy is hit)
+        cowboys_to_proceed = []
         for c in self.cowboy_list:
             if c.position is not None:
-                self.active_cowboys.append(c)
+                cowboys_to_proceed.append(c)
 
-        shuffle(self.active_cowboys)
-        # make copy so that self.active_cowboys could be modified during the turn (when cowboy is hit)
-        cowboys_to_proceed = self.active_cowboys.copy()
+        shuffle(cowboys_to_proceed)
+        self.active_cowboys = RankedList(cowboys_to_proceed)
 
         # Ensure BFS is computed for all position of cowboys (in parallel)
         # cowboys_to_compute = [cowboy for cowboy in cowboys_to_proceed if cowboy.position not in self.cached_distances]
@@ -729,14 +905,29 @@ class GameMap:
         #     self.bfs_time += time.time() - start_time
 
         cowboy_results: list[list[str]] = [[] for _ in self.teams]
+        cowboy_profiles: list[Profile | None] = [None for _ in self.teams]
+        # Programs may be changed by teams during the turn, the turn uses these
+        programs = [team.get_cowboy_program() for team in self.teams]
+
+        speculative = None
+        if self.pool is not None and not self.profiling:
+            speculative = self.run_cowboys_in_parallel(cowboys_to_proceed, programs)
+            self.written = set()
+        reused = 0
 
         # In this order, process their moves.
-        for cowboy in cowboys_to_proceed:
+        for i, cowboy in enumerate(cowboys_to_proceed):
             if cowboy.position is None:
                 continue  # cowboy was hit in this turn
 
-            program = self.teams[cowboy.team].get_cowboy_program()
-            status, action, steps = program.execute(self.COWBOY_MAX_STEPS, self, cowboy)
+            program = programs[cowboy.team]
+            profile = self._profile(cowboy_profiles, cowboy.team, program)
+            if speculative is not None and speculative[i][3].isdisjoint(self.written):
+                # Nothing the program read has changed since the start of the turn
+                status, action, steps, _ = speculative[i]
+                reused += 1
+            else:
+                status, action, steps = program.execute(self.COWBOY_MAX_STEPS, self, cowboy, profile=profile)
             print(f"GAME[ACTION]: {cowboy}: status={status}, steps={steps}, result={action}")
 
             if not status:
@@ -761,9 +952,13 @@ class GameMap:
                     if self.wall_grid[new_y][new_x] or self.cowboy_grid[new_y][new_x] is not None:
                         continue
                     # Make the move
+                    if self.written is not None:
+                        self.wrote(("cowboy", self.active_cowboys.index(cowboy)))
                     self.cowboy_grid[y][x] = None
                     cowboy.position = (new_x, new_y)
                     self.cowboy_grid[new_y][new_x] = cowboy
+                    self.update_free_square(x, y)
+                    self.update_free_square(new_x, new_y)
                     # Check for collision:
                     bullet = self.bullet_grid[new_y][new_x]
                     if bullet is not None:
@@ -772,14 +967,18 @@ class GameMap:
                     gold = self.gold_grid[new_y][new_x]
                     if gold is not None:
                         gold.position = None
+                        self.update_live_gold(gold)
                         self.gold_grid[new_y][new_x] = None
+                        self.update_free_square(new_x, new_y)
                         golds_to_respawn.append(gold)
                         self.team_stats[cowboy.team].golds += 1
                         self.team_stats[cowboy.team].points += self.GOLD_PRICE
+                        self.wrote(("points", cowboy.team))
 
                 elif action.type == ActionType.FIRE:
                     self.team_stats[cowboy.team].points -= self.BULLET_PRICE
                     self.team_stats[cowboy.team].fired_bullets += 1
+                    self.wrote(("points", cowboy.team))
                     self.current_gun_triggers.append((x, y, bullet_directions.index(d)))
 
                     print(f"GAME[ACTION]: Fired bullet at {new_x},{new_y} with direction {d}")
@@ -793,39 +992,67 @@ class GameMap:
 
                     bullet = Bullet(cowboy.team, (new_x, new_y), bullet_directions.index(d))
                     self.bullet_grid[new_y][new_x] = bullet
+                    self.update_free_square(new_x, new_y)
                     other_cowboy = self.cowboy_grid[new_y][new_x]
                     self.bullet_list.append(bullet)
+                    self.wrote(BULLETS)
                     if other_cowboy is not None:
                         self.bullet_hit(other_cowboy, bullet)
 
+        self.written = None
+        if speculative is not None:
+            self.speculative_runs += len(speculative)
+            self.speculative_reused += reused
+            print(f"GAME[INFO]: {reused} of {len(speculative)} cowboy programs run in parallel were valid")
+
         # Respawn golds that were taken this turn:
-        for gold in golds_to_respawn:
-            self.spawn_gold(gold)
+        self.spawn_golds(golds_to_respawn)
+        self.active_cowboys.compact()
+        self.bullet_list.compact()
 
         self.turn_idx += 1
         self.bullet_subturn = 0
         self.save()
 
         self.cowboy_results.append(cowboy_results)
+        self.cowboy_profiles = cowboy_profiles
 
         elapsed = time.time() - start_time
-        print(f"GAME[TURN] Cowboy turn {self.turn_idx - 1} completed in {elapsed}s (bfs time: {self.bfs_time}s)")
+        cache = self.cached_distances
+        print(f"GAME[TURN] Cowboy turn {self.turn_idx - 1} completed in {elapsed}s (bfs time: {self.bfs_time}s, "
+              f"distance cache: {cache.hits} hits, {cache.misses} misses, {cache.evictions} evictions)")
+
+    # Results of cowboy programs run against the map at the start of the
+    # turn by the pool, with what each program read (see `parallel.py`)
+    def run_cowboys_in_parallel(self, cowboys: list[Cowboy], programs: list[Program]) -> list[Any]:
+        from .parallel import Snapshot, run_cowboys
+        assert self.pool is not None
+        snapshot = Snapshot(self, cowboys, programs)
+        workers = self.parallel_workers
+        chunks = [range(w, len(cowboys), workers) for w in range(workers)]
+        results: list[Any] = [None] * len(cowboys)
+        for chunk, chunk_results in zip(chunks, self.pool.starmap(run_cowboys, [(snapshot, c) for c in chunks])):
+            for i, result in zip(chunk, chunk_results):
+                results[i] = result
+        return results
 
     def simulate_bullets_turn(self) -> None:
         start_time = time.time()
 
         bullet_results: list[list[str]] = [[] for _ in self.teams]
+        bullet_profiles: list[Profile | None] = [None for _ in self.teams]
 
         self.current_explosions = []
         # Bullets fly in order in which they are fired
         # Make copy of the list to not skip any when bullet_list is modified
-        bullets_order = self.bullet_list.copy()
+        bullets_order = list(self.bullet_list)
         for bullet in bullets_order:
             if bullet.position is None:
                 continue
 
             program = self.teams[bullet.team].get_bullet_program()
-            status, action, steps = program.execute(self.BULLET_MAX_STEPS, self, bullet)
+            profile = self._profile(bullet_profiles, bullet.team, program)
+            status, action, steps = program.execute(self.BULLET_MAX_STEPS, self, bullet, profile=profile)
             print(f"GAME[ACTION]: {bullet}: status={status}, steps={steps}, result={action}")
 
             if not status:
@@ -854,6 +1081,7 @@ class GameMap:
                 continue
 
             self.bullet_grid[y][x] = None
+            self.update_free_square(x, y)
             bullet.position = (new_x, new_y)
 
             another_bullet = self.bullet_grid[new_y][new_x]
@@ -867,6 +1095,7 @@ class GameMap:
                 continue
 
             self.bullet_grid[new_y][new_x] = bullet
+            self.update_free_square(new_x, new_y)
             bullet.turns_made += 1
             if bullet.turns_made >= self.BULLET_LIFETIME:
                 self.bullet_disappear(bullet)
@@ -877,15 +1106,33 @@ class GameMap:
             if self.cowboy_grid[y][x] is not None:
                 new_gun_triggers.append((x, y, dd))
         self.current_gun_triggers = new_gun_triggers
+        self.active_cowboys.compact()
+        self.bullet_list.compact()
 
         self.bullet_subturn += 1
         self.save()
 
         self.bullet_results.append(bullet_results)
+        self.bullet_profiles = bullet_profiles
 
         elapsed = time.time() - start_time
         print(f"GAME[TURN] Bullet subturn {self.turn_idx}:{self.bullet_subturn - 1} completed in {elapsed}s")
 
+    def _profile(self, profiles: list[Profile | None], team: int, program: Program) -> Profile | None:
+        """Profile of the team's program in this turn, None if profiling is off."""
+        if not self.profiling:
+            return None
+        profile = profiles[team]
+        if profile is None or profile.program is not program:
+            profile = profiles[team] = Profile(program)
+        return profile
+
+    def get_cowboy_profile(self, team: Team) -> Profile | None:
+        return self.cowboy_profiles[self.teams.index(team)]
+
+    def get_bullet_profile(self, team: Team) -> Profile | None:
+        return self.bullet_profiles[self.teams.index(team)]
+
     def get_cowboy_results(self, team: Team, last_n_round: int = 5):
         index = self.teams.index(team)
         return [
@@ -959,30 +1206,23 @@ class GameMap:
     def maximum_metric(self, start: Coords, goal: Coords) -> int:
         return max(self.coord_diffs(start, goal))
 
-    def bfs(self, start: Coords, dirs: list[Direction]):
+    # Distances from start indexed by `y * width + x`
+    def bfs(self, start: Coords, dirs: list[Direction]) -> list[int]:
         start_time = time.time()
 
-        dists_from_start = [[self.infty for _ in range(self.width)] for _ in range(self.height)]
-        q: queue.Queue[tuple[int, Coords]] = queue.Queue()
-        q.put((0, start))
-        while not q.empty():
-            dist, (x, y) = q.get()
-            if dists_from_start[y][x] < self.infty or self.wall_grid[y][x]:
-                continue
-            dists_from_start[y][x] = dist
-            for d in dirs:
-                q.put((dist + 1, ((x + d.value[0]) % self.width, (y + d.value[1]) % self.height)))
+        grid_bfs = self.bullet_bfs if dirs is bullet_directions else self.cowboy_bfs
+        assert dirs is bullet_directions or dirs is cowboy_directions
+        dists_from_start = grid_bfs.distances([grid_bfs.square(start)], self.wall_squares, self.infty)
 
         self.bfs_time += time.time() - start_time
         return dists_from_start
 
-    def compute_cowboy_distances(self, cowboy: Cowboy) -> list[list[int]] | None:
-        if cowboy.position is None:
+    # Distances indexed by `y * width + x`
+    def compute_cowboy_distances(self, cowboy: Cowboy) -> Sequence[int] | None:
+        position = cowboy.position
+        if position is None:
             return None
-        if cowboy.position not in self.cached_distances:
-            self.cached_distances[cowboy.position] = self.bfs(cowboy.position, cowboy_directions)
-
-        return self.cached_distances[cowboy.position]
+        return self.cached_distances.get(position, lambda: self.bfs(position, cowboy_directions))
 
     # Returns the length of the shortest path of the object to (x, y).
     # If unreachable, returns a sort of "infinite" value
@@ -991,11 +1231,14 @@ class GameMap:
         if context is None or x < 0 or x >= self.width or y < 0 or y >= self.height:
             return self.width * self.height
 
+        if self.distance_table is not None:
+            return self.infty if context.position is None else self.distance_table.distance(context.position, pos)
+
         distances = self.compute_cowboy_distances(context)
         if distances is None:
             return self.infty
 
-        return distances[y][x]
+        return distances[y * self.width + x]
 
     # Returns the direction (index of direction) of the first step to (x, y).
     def which_way(self, context: Cowboy, pos: Coords) -> Coords:
@@ -1006,17 +1249,28 @@ class GameMap:
         if context is None or x < 0 or x >= self.width or y < 0 or y >= self.height:
             return (0, 0)
 
+        if self.distance_table is not None:
+            return (0, 0) if context.position is None else self.distance_table.first_step(context.position, pos)
+
         distances = self.compute_cowboy_distances(context)
         if distances is None:
             return (0, 0)
 
-        # (x, y) will change from here
+        assert context.position is not None
+        key = (context.position, pos)
+        if key not in self.first_steps:
+            self.first_steps[key] = self.first_step(distances, context.position, pos)
+        return self.first_steps[key]
+
+    # Walks back from `pos` along decreasing `distances` to `start`
+    def first_step(self, distances: Sequence[int], start: Coords, pos: Coords) -> Coords:
+        x, y = pos
         while True:
             xy_changed = False
             for d in cowboy_directions:
                 new_x, new_y = (x + d.value[0]) % self.width, (y + d.value[1]) % self.height
-                if distances[new_y][new_x] < distances[y][x]:
-                    if context.position == (new_x, new_y):
+                if distances[new_y * self.width + new_x] < distances[y * self.width + x]:
+                    if start == (new_x, new_y):
                         return (-d.value[0], -d.value[1])
                     x, y = new_x, new_y
                     xy_changed = True
@@ -1026,7 +1280,7 @@ class GameMap:
                 return (0, 0)
 
     def number_of_golds(self):
-        return sum([0 if self.gold_list[i].position is None else 1 for i in range(self.gold_count)])
+        return len(self.live_gold_positions)
 
     def number_of_cowboys(self):
         return len(self.active_cowboys)
@@ -1034,13 +1288,9 @@ class GameMap:
     # The coordinates of the i-th currently present gold on the map.
     # Returns (-1, -1) if the index i is out of bounds.
     def gold_i_position(self, i: int) -> Coords:
-        idx = 0
-        for gold in self.gold_list:
-            if gold.position is not None:
-                if idx == i:
-                    return gold.position
-                idx += 1
-        return (-1, -1)
+        if i < 0 or i >= len(self.live_gold_positions):
+            return (-1, -1)
+        return self.live_gold_positions[i]
 
     def number_of_bullets(self):
         return len(self.bullet_list)
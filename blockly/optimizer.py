@@ -0,0 +1,101 @@
+"""Optimization pass run on parsed programs.
+
+Subtrees which do not depend on the game (numbers, booleans, directions and
+operations on them) are computed once and replaced by `Constant` blocks which
+charge all the steps of the subtree at once, so step counts do not change.
+Branches of `ControlsIf` which could never run are dropped.
+
+The pass is recursive and needs more stack than parsing, so programs nested
+too deeply for it stay (partly) unoptimized, which runs the same.
+"""
+from __future__ import annotations
+import sys
+from typing import Type, cast
+
+from .blocks import (
+    Block, BlockInputKind, Run, Constant, arithmetic_operators,
+    LogicBoolean, MathNumber, ConstantDirection, LogicCompare, LogicOperation, LogicNegate, MathAbs,
+    MathArithmeticCustom, TransformXYPosition, TransformPositionX, TransformPositionY, ControlsIf,
+)
+
+# Blocks which compute the same value every time if all their inputs are constant
+foldable_blocks: set[Type[Block]] = {
+    LogicBoolean, MathNumber, ConstantDirection, LogicCompare, LogicOperation, LogicNegate, MathAbs,
+    MathArithmeticCustom, TransformXYPosition, TransformPositionX, TransformPositionY,
+}
+
+# Do not compute huge powers during parsing, they are left for the run (which would run out of steps)
+MAX_FOLDED_POWER_BITS = 1024
+
+
+def optimize(block: Block | None) -> Block | None:
+    """Optimizes program starting with `block`, returns the new first block."""
+    try:
+        return optimize_chain(block)
+    except RecursionError:
+        # Every replaced subtree computes the same as the original one
+        return block
+
+
+def optimize_chain(block: Block | None) -> Block | None:
+    """Optimizes chain of blocks starting with `block`, returns the new first block."""
+    first = block = fold_constants(block) if block is not None else None
+    while block is not None and block.has_next:
+        block.next = fold_constants(block.next) if block.next is not None else None
+        block = block.next
+    return first
+
+
+def fold_constants(block: Block) -> Block:
+    """Optimizes `block` and its inputs (but not blocks after it)."""
+    constant_inputs = True
+    for input in block.inputs:
+        if input.attr is None or input.kind == BlockInputKind.FIELD:
+            continue
+        child = optimize_chain(getattr(block, input.attr))
+        setattr(block, input.attr, child)
+        if input.kind == BlockInputKind.VALUE and not isinstance(child, Constant):
+            constant_inputs = False
+
+    if isinstance(block, ControlsIf):
+        _prune_branches(block)
+        return block
+
+    if not constant_inputs or type(block) not in foldable_blocks:
+        return block
+    if isinstance(block, MathArithmeticCustom) and not _small_power(block):
+        return block
+
+    run = Run(max_steps=sys.maxsize, variables=[], map=None, context=None)  # type: ignore
+    try:
+        value = block.execute(run)
+    except Exception:
+        # Keep the error for the run
+        return block
+    return Constant(value, run.steps, block.returns)  # type: ignore
+
+
+def _small_power(block: MathArithmeticCustom) -> bool:
+    if block.operation is not arithmetic_operators["POWER"]:
+        return True
+    A = cast(Constant, block.block_A).value
+    B = cast(Constant, block.block_B).value
+    return isinstance(A, int) and isinstance(B, int) and abs(A).bit_length() * B <= MAX_FOLDED_POWER_BITS
+
+
+def _prune_branches(block: ControlsIf) -> None:
+    conditions: list[tuple[Block, Block | None]] = []
+    for (condition, do) in block.conditions:
+        condition = fold_constants(condition)
+        do = optimize_chain(do)
+        if isinstance(condition, Constant) and condition.value is not True:
+            # Condition is still evaluated (for its steps), but never holds
+            do = None
+        conditions.append((condition, do))
+        if isinstance(condition, Constant) and condition.value is True:
+            # Later conditions and else are never evaluated
+            block.conditions = conditions
+            block.do_else = None
+            return
+    block.conditions = conditions
+    block.do_else = optimize_chain(block.do_else)
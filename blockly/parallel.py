@@ -0,0 +1,203 @@
+"""Speculative parallel execution of cowboy programs.
+
+Programs of all cowboys are run at once in a pool of processes against a
+snapshot of the map from the start of the cowboy turn, each run records what
+it read from the map. Then the actions are applied in the shuffled order as
+usual, the map records what every action changed (`GameMap.wrote`), and a
+result is used only if nothing it read has been changed by the actions
+before it. Otherwise the program is run again on the map itself. The results
+are the same as when the programs are run one by one.
+
+Reads and changes are described by keys:
+
+* `("cell", x, y)` - whether there is a cowboy, gold or bullet on a square
+* `("cowboy", i)` - position of the i-th cowboy of the turn
+* `COWBOY_ORDER` - which cowboys are in the turn (count, indices, teams, `my_id`)
+* `GOLDS`, `BULLETS` - the golds / bullets on the map and their indices
+* `("points", team)`
+
+Walls, distances and the cowboy's own position do not change before the
+cowboy's own action, so they are not recorded.
+
+The worker processes are forked by `GameMap.start_pool` when the map is
+created, each inherits a `SnapshotMap` with the walls (and the distance
+table) of the map. Only the state which changes (`Snapshot`) is
+sent every turn. Workers keep caches of distances between turns and the
+programs of the last turn parsed.
+"""
+from __future__ import annotations
+from typing import Any, Sequence
+
+from .actions import Action
+from .blocks import cowboy_factories
+from .distances import DistanceCache
+from .exceptions import ProgramParseException
+from .map import GameMap, Cowboy, Bullet, TeamStats, Coords, COWBOY_ORDER, GOLDS, BULLETS
+from .parser import Parser
+from .program import Program, nop_program
+from .ranked import RankedList
+
+# status, action or error, steps and the keys read
+Result = tuple[bool, Action | str, int, set[Any]]
+
+
+class Snapshot:
+    """What cowboy programs can read from the map at the start of a turn,
+    besides the walls."""
+    turn_idx: int
+    max_steps: int
+    cowboys: list[Cowboy]  # in the order of the turn
+    bullets: list[Bullet]
+    gold_positions: list[Coords]
+    team_stats: list[TeamStats]
+    occupied: tuple[bytes, bytes, bytes]  # cowboy / gold / bullet on each square
+    programs: list[str | None]  # XML of the cowboy program of each team, None if it does nothing
+
+    def __init__(self, game_map: GameMap, cowboys: list[Cowboy], programs: list[Program]) -> None:
+        self.turn_idx = game_map.turn_idx
+        self.max_steps = game_map.COWBOY_MAX_STEPS
+        self.cowboys = cowboys
+        self.bullets = list(game_map.bullet_list)
+        self.gold_positions = game_map.live_gold_positions
+        self.team_stats = game_map.team_stats
+        self.occupied = tuple(
+            bytes(square is not None for row in grid for square in row)
+            for grid in (game_map.cowboy_grid, game_map.gold_grid, game_map.bullet_grid)
+        )
+        self.programs = [None if program is nop_program else program.raw_xml for program in programs]
+
+
+class RecordingGrid:
+    """Grid of a snapshot (non-None where occupied) for `grid[r][c]`, which
+    records the squares read."""
+    rows: list[list[bool | None]]
+    reads: set[Any]
+
+    def __init__(self, occupied: bytes, width: int, reads: set[Any]) -> None:
+        self.rows = [[True if occupied[y * width + x] else None for x in range(width)]
+                     for y in range(len(occupied) // width)]
+        self.reads = reads
+
+    def __getitem__(self, r: int) -> RecordingRow:
+        return RecordingRow(self.rows[r], r % len(self.rows), self.reads)
+
+
+class RecordingRow:
+    __slots__ = ("row", "y", "reads")
+
+    def __init__(self, row: list[bool | None], y: int, reads: set[Any]) -> None:
+        self.row = row
+        self.y = y
+        self.reads = reads
+
+    def __getitem__(self, c: int) -> bool | None:
+        value = self.row[c]
+        self.reads.add(("cell", c % len(self.row), self.y))
+        return value
+
+
+class SnapshotMap(GameMap):
+    """Map of a worker process, with the walls of the game and the state of
+    the last snapshot. Queries add their keys into `reads`."""
+    reads: set[Any]
+
+    def __init__(self, game_map: GameMap) -> None:  # the state of a game is not needed
+        self.width, self.height = game_map.width, game_map.height
+        self.infty = game_map.infty
+        self.wall_grid = game_map.wall_grid
+        self.wall_squares = game_map.wall_squares
+        self.init_bfs()
+        self.cached_distances = DistanceCache(self.DISTANCE_CACHE_SIZE, self.infty)
+        self.distance_table = game_map.distance_table
+        self.bfs_time = 0
+        self.reads = set()
+
+    def update(self, snapshot: Snapshot) -> None:
+        self.turn_idx = snapshot.turn_idx
+        self.active_cowboys = RankedList(snapshot.cowboys)
+        self.bullet_list = RankedList(snapshot.bullets)
+        self.live_gold_positions = snapshot.gold_positions
+        self.team_stats = snapshot.team_stats
+        self.first_steps = {}
+        self.reads = set()
+        self.cowboy_grid, self.gold_grid, self.bullet_grid = (  # type: ignore[assignment]
+            RecordingGrid(occupied, self.width, self.reads) for occupied in snapshot.occupied)
+
+    def run(self, cowboy: Cowboy, program: Program, max_steps: int) -> Result:
+        self.reads.clear()
+        status, action, steps = program.execute(max_steps, self, cowboy)
+        return status, action, steps, set(self.reads)
+
+    def number_of_golds(self):
+        self.reads.add(GOLDS)
+        return super().number_of_golds()
+
+    def gold_i_position(self, i: int) -> Coords:
+        self.reads.add(GOLDS)
+        return super().gold_i_position(i)
+
+    def number_of_cowboys(self):
+        self.reads.add(COWBOY_ORDER)
+        return super().number_of_cowboys()
+
+    def cowboy_i(self, i: int) -> Cowboy | None:
+        self.reads.add(COWBOY_ORDER)
+        return super().cowboy_i(i)
+
+    def cowboy_i_position(self, i: int) -> Coords:
+        self.reads.add(("cowboy", i))
+        return super().cowboy_i_position(i)
+
+    def number_of_bullets(self):
+        self.reads.add(BULLETS)
+        return super().number_of_bullets()
+
+    def bullet_i(self, i: int) -> Bullet | None:
+        self.reads.add(BULLETS)
+        return super().bullet_i(i)
+
+    def my_id(self, context: Cowboy | Bullet) -> int:
+        self.reads.add(COWBOY_ORDER)
+        return super().my_id(context)
+
+    def my_points(self, context: Cowboy | Bullet) -> int:
+        self.reads.add(("points", context.team))
+        return super().my_points(context)
+
+
+# State of a worker process
+_worker_map: SnapshotMap | None = None
+_programs: dict[str, Program] = {}  # programs of the last snapshot by XML
+
+
+def init_worker(worker_map: SnapshotMap) -> None:
+    """Initializer of a forked worker, `worker_map` is inherited, not sent."""
+    global _worker_map
+    _worker_map = worker_map
+
+
+def _parse(xml: str) -> Program:
+    try:
+        return Parser(cowboy_factories).parse_program(xml)
+    except ProgramParseException:
+        return Program(None, None, xml)  # not runnable, as in the game
+
+
+def _update_programs(snapshot: Snapshot) -> None:
+    global _programs
+    _programs = {xml: _programs.get(xml) or _parse(xml) for xml in snapshot.programs if xml is not None}
+
+
+def _program(xml: str | None) -> Program:
+    return nop_program if xml is None else _programs[xml]
+
+
+def run_cowboys(snapshot: Snapshot, indices: Sequence[int]) -> list[Result]:
+    """Runs the programs of cowboys at `indices` of `snapshot.cowboys` (in a worker)."""
+    assert _worker_map is not None
+    _worker_map.update(snapshot)
+    _update_programs(snapshot)
+    return [
+        _worker_map.run(cowboy, _program(snapshot.programs[cowboy.team]), snapshot.max_steps)
+        for cowboy in (snapshot.cowboys[i] for i in indices)
+    ]
@@ -3,6 +3,7 @@ import xml.etree.ElementTree as ET
 
 from .blocks import Block, Field, StaticField, VariableField
 from .exceptions import ProgramParseException
+from .optimizer import optimize
 from .program import Program
 
 
@@ -24,12 +25,14 @@ class ParserInstance:
     """
     factories: dict[str, Type[Block]]
     variables: dict[str, list[VariableField]]
+    slots: dict[str, int]
 
     def __init__(self, factories: dict[str, Type[Block]]) -> None:
         self.factories = factories
         self.variables = {}
+        self.slots = {}
 
-    def parse_program(self, xml_input: str) -> tuple[Block, dict[str, type]]:
+    def parse_program(self, xml_input: str) -> tuple[Block, dict[str, type | Any]]:
         root_block: Block | None = None
 
         for el in ET.XML(xml_input):
@@ -46,8 +49,8 @@ class ParserInstance:
         if root_block is None:
             raise ProgramParseException("No block to execute")
 
-        # Check variable types
-        variables: dict[str, type] = {}
+        # Check variable types, all variables are kept in the order of their slots
+        variables: dict[str, type | Any] = {}
         for variable, instances in self.variables.items():
             for instance in instances:
                 if instance.var_type is Any:
@@ -56,11 +59,15 @@ class ParserInstance:
                 if variable in variables and variables[variable] != instance.var_type:
                     raise ProgramParseException(f"Variable {variable} has type conflict ({variables[variable]} and {instance.var_type})")
                 variables[variable] = instance.var_type
+            variables.setdefault(variable, Any)
 
+        root_block = optimize(root_block)
+        assert root_block is not None
         return root_block, variables
 
     def parse_variables(self, xml_variables: ET.Element):
         self.variables = {}
+        self.slots = {}
         for variable in xml_variables:
             if variable.text is None:
                 raise ProgramParseException("Empty variable definition")
@@ -68,6 +75,7 @@ class ParserInstance:
             if var in self.variables:
                 raise ProgramParseException(f"Duplicate variable {var}")
             self.variables[var] = []
+            self.slots[var] = len(self.slots)
 
     def parse_block(self, path: str, block: ET.Element) -> Block:
         type = block.attrib['type']
@@ -97,7 +105,7 @@ class ParserInstance:
                 if name == "VAR":
                     if value not in self.variables:
                         raise ProgramParseException(f"{el_path}: Variable {value} not specified in <variables>")
-                    field = VariableField(value)
+                    field = VariableField(value, self.slots[value])
                     self.variables[value].append(field)
                 else:
                     field = StaticField(name, value)
@@ -0,0 +1,159 @@
+"""Profiling of programs per block.
+
+`instrument` copies a block tree and wraps every block into `ProfiledBlock`,
+which records how many times the block ran, the steps it charged itself
+(without its inputs, statements and following blocks) and the time spent in
+it (also without nested blocks). The copy is compiled into closures (see
+`compiler.compile_chain`, which wraps the closure of every `ProfiledBlock`
+by `measure`) and run with `ProfiledRun`, so long chains of blocks run in a
+loop as without profiling. Results are accumulated in its `Profile`, which
+may be shared by many runs (e.g. by all cowboys of a team during one turn).
+"""
+from __future__ import annotations
+import copy
+from time import perf_counter
+from typing import Any, Callable, TYPE_CHECKING
+
+from .blocks import Block, BlockInputKind, Run, Value, ControlsIf
+
+# Brake circular dependency only used for type checking
+if TYPE_CHECKING:
+    from .map import GameMap, Cowboy, Bullet
+    from .program import Program
+
+
+class BlockStats:
+    __slots__ = ("index", "name", "count", "steps", "time")
+    index: int  # order of the block in the program (depth-first)
+    name: str  # `Block.name`
+    count: int  # executions
+    steps: int  # steps charged by the block itself
+    time: float  # seconds spent in the block itself
+
+    def __init__(self, index: int, name: str) -> None:
+        self.index = index
+        self.name = name
+        self.count = 0
+        self.steps = 0
+        self.time = 0.0
+
+
+class Profile:
+    """Accumulated statistics of blocks of one program."""
+    program: Program
+    blocks: list[BlockStats]  # by `ProfiledBlock.index`
+    runs: int
+    # (steps, time) of profiled blocks nested in the currently running ones
+    _nested: list[list[Any]]
+
+    def __init__(self, program: Program) -> None:
+        self.program = program
+        self.blocks = [BlockStats(s.index, s.name) for s in program.profiled()[1]]
+        self.runs = 0
+        self._nested = []
+
+    def reset(self) -> None:
+        """Forgets blocks left running by an interrupted run."""
+        self._nested.clear()
+
+    def total_steps(self) -> int:
+        return sum(b.steps for b in self.blocks)
+
+    def hot_blocks(self, limit: int | None = None) -> list[BlockStats]:
+        """Executed blocks, the most expensive (by steps, then by time) first."""
+        executed = [b for b in self.blocks if b.count > 0]
+        executed.sort(key=lambda b: (b.steps, b.time), reverse=True)
+        return executed[:limit]
+
+
+class ProfiledRun(Run):
+    """Run which records statistics of executed `ProfiledBlock`s into `profile`."""
+    __slots__ = ("profile",)
+    profile: Profile
+
+    def __init__(self, max_steps: int, variables: list[Value], map: GameMap,
+                 context: Cowboy | Bullet, profile: Profile) -> None:
+        super().__init__(max_steps, variables, map, context)
+        self.profile = profile
+
+
+class ProfiledBlock:
+    """Stands for `block` in the instrumented tree."""
+    __slots__ = ("block", "index")
+    block: Block
+    index: int
+
+    def __init__(self, block: Block, index: int) -> None:
+        self.block = block
+        self.index = index
+
+    def __getattr__(self, name: str) -> Any:
+        # Parent blocks may read attributes of their children (e.g. `returns`)
+        return getattr(self.block, name)
+
+    def execute(self, run: Run) -> Any:
+        return _measured(run, self.index, self.block.execute)
+
+
+def measure(block: ProfiledBlock, f: Callable[[Run], Any]) -> Callable[[Run], Any]:
+    """Wraps `f` (compiled `block.block`) to record statistics of `block`."""
+    index = block.index
+
+    def measured(run: Run) -> Any:
+        return _measured(run, index, f)
+    return measured
+
+
+def _measured(run: Run, index: int, f: Callable[[Run], Any]) -> Any:
+    assert isinstance(run, ProfiledRun)
+    nested = run.profile._nested
+    nested.append([0, 0.0])
+    start_steps = run.steps
+    start = perf_counter()
+    try:
+        return f(run)
+    finally:
+        elapsed = perf_counter() - start
+        steps = run.steps - start_steps
+        nested_steps, nested_time = nested.pop()
+        stats = run.profile.blocks[index]
+        stats.count += 1
+        stats.steps += steps - nested_steps
+        stats.time += elapsed - nested_time
+        if nested:
+            nested[-1][0] += steps
+            nested[-1][1] += elapsed
+
+
+def instrument(root: Block) -> tuple[Block, list[BlockStats]]:
+    """Returns a copy of the tree with all blocks wrapped in `ProfiledBlock` and
+    empty statistics of all the blocks (their order gives `ProfiledBlock.index`).
+    The original tree is not modified."""
+    blocks: list[BlockStats] = []
+
+    def wrap(block: Block | None) -> Any:
+        """Wraps chain of blocks starting with `block`, in a loop over `next`."""
+        first: ProfiledBlock | None = None
+        previous: ProfiledBlock | None = None
+        while block is not None:
+            wrapped = ProfiledBlock(copy.copy(block), len(blocks))
+            blocks.append(BlockStats(len(blocks), block.name))
+            block = wrapped.block
+
+            for input in block.inputs:
+                if input.attr is not None and input.kind != BlockInputKind.FIELD:
+                    setattr(block, input.attr, wrap(getattr(block, input.attr)))
+            if isinstance(block, ControlsIf):
+                block.conditions = [(wrap(condition), wrap(do))
+                                    for (condition, do) in block.conditions]
+                block.do_else = wrap(block.do_else)
+
+            if previous is None:
+                first = wrapped
+            else:
+                previous.block.next = wrapped
+            previous = wrapped
+            block = block.next if block.has_next else None
+        return first
+
+    return wrap(root), blocks
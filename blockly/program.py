@@ -1,48 +1,119 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from enum import Enum
+from typing import Any, TYPE_CHECKING
 import traceback
 
 from .actions import Action
-from .blocks import Block, Run, Nop, Position
+from .analysis import step_bound
+from .blocks import Block, Run, UncheckedRun, Nop, Value, UNSET, variable_defaults
+from .codegen import generate
+from .compiler import Compiled, compile_chain
 from .exceptions import OutOfStepsException
+from .profiler import BlockStats, Profile, ProfiledRun, instrument
 
 # Brake circular dependency only used for type checking
 if TYPE_CHECKING:
     from .map import GameMap, Cowboy, Bullet
 
 
+class Engine(Enum):
+    TREE = "tree"  # recursive `Block.execute`, reference implementation
+    CLOSURES = "closures"  # block tree compiled into nested closures
+    CODEGEN = "codegen"  # generated Python function (closures if not possible)
+
 
 class Program:
     raw_xml: str
     root: Block | None
-    variables: dict[str, type] | None
+    variables: dict[str, type | Any] | None  # in the order of slots, Any if type is not known
+    # Initial values of `Run.variables`, copied for every execution
+    defaults: list[Value]
+    # `root` compiled into closures (by `compiler.compile_chain`), None if it is
+    # nested too deeply to be compiled (it is interpreted then)
+    compiled: Compiled | None
+    # `root` as generated Python functions (by `codegen.generate`) with and without
+    # checking the step limit, created on first use
+    _generated: dict[bool, Compiled | None]
+    # Maximum steps of any run (None if unknown), by `analysis.step_bound`
+    step_bound: int | None
+    # `root` instrumented for profiling (by `profiler.instrument`) and compiled,
+    # created on first use (None and no blocks if it is nested too deeply)
+    _profiled: tuple[Compiled | None, list[BlockStats]] | None
 
-    def __init__(self, root: Block | None, variables: dict[str, type] | None, raw_xml: str) -> None:
+    def __init__(self, root: Block | None, variables: dict[str, type | Any] | None, raw_xml: str) -> None:
         self.root = root
         self.variables = variables
         self.raw_xml = raw_xml
+        self.defaults = [variable_defaults.get(t, UNSET) for t in (variables or {}).values()]
+        self.compiled = None
+        if root is not None:
+            try:
+                self.compiled = compile_chain(root)
+            except RecursionError:
+                print("WARN: Program nested too deeply to be compiled, it is interpreted")
+        self._generated = {}
+        self.step_bound = None
+        if root is not None:
+            try:
+                self.step_bound = step_bound(root)
+            except RecursionError:
+                pass  # unknown, the limit is checked
+        self._profiled = None
+
+    def generated(self, checked: bool = True) -> Compiled | None:
+        if checked not in self._generated:
+            self._generated[checked] = generate(self, checked)
+        return self._generated[checked]
+
+    def profiled(self) -> tuple[Compiled | None, list[BlockStats]]:
+        assert self.root is not None
+        if self._profiled is None:
+            try:
+                root, blocks = instrument(self.root)
+                self._profiled = compile_chain(root), blocks
+            except RecursionError:
+                self._profiled = None, []
+        return self._profiled
 
     def valid(self) -> bool:
         return self.root is not None
 
     # returns (True/False, action/string error, #steps)
-    def execute(self, max_steps: int, map: GameMap, context: Cowboy | Bullet) -> tuple[bool, Action | str, int]:
+    # With `profile` (created for this program), the instrumented program is run
+    # as closures and statistics of its blocks are added to the profile.
+    def execute(self, max_steps: int, map: GameMap, context: Cowboy | Bullet,
+                engine: Engine = Engine.CODEGEN, profile: Profile | None = None) -> tuple[bool, Action | str, int]:
         if self.root is None or self.variables is None:
             return False, "Not executable", 0
 
-        variables: dict[str, bool | int | Position] = {}
-        for key, t in self.variables.items():
-            if t == bool:
-                variables[key] = False
-            elif t == int:
-                variables[key] = 0
-            elif t == Position:
-                variables[key] = (0, 0)
-
-        run = Run(max_steps=max_steps, variables=variables, map=map, context=context)
+        # Step limit does not need to be checked if the program could not exceed it
+        checked = self.step_bound is None or self.step_bound > max_steps
+        profiled = self.profiled()[0] if profile is not None else None
+        run: Run
+        if profile is not None and profiled is not None:
+            assert profile.program is self
+            profile.runs += 1
+            run = ProfiledRun(max_steps=max_steps, variables=self.defaults.copy(), map=map, context=context,
+                              profile=profile)
+        else:
+            run_class = Run if checked else UncheckedRun
+            run = run_class(max_steps=max_steps, variables=self.defaults.copy(), map=map, context=context)
 
         try:
-            result = self.root.execute(run)
+            if profile is not None and profiled is not None:
+                try:
+                    result = profiled(run)
+                except RecursionError:
+                    # The instrumented program needs more stack than the program itself,
+                    # profiling must not change the result
+                    profile.reset()
+                    return self.execute(max_steps, map, context, engine)
+            elif engine == Engine.TREE or self.compiled is None:
+                result = self.root.execute(run)
+            elif engine == Engine.CODEGEN and (generated := self.generated(checked)) is not None:
+                result = generated(run)
+            else:
+                result = self.compiled(run)
             steps = run.steps
             if result is None:
                 return False, "No action", steps
@@ -50,7 +121,8 @@ class Program:
                 return False, f"Expected Action, {type(result)} returned", steps
             return True, result, steps
         except OutOfStepsException:
-            return False, "Out of steps", run.steps
+            # Constants charge several steps at once, report it as if they were charged one by one
+            return False, "Out of steps", min(run.steps, max_steps + 1)
         except Exception as e:
             traceback.print_tb(e.__traceback__)
             return False, f"Should not happen, exception: {e}", run.steps
@@ -0,0 +1,99 @@
+"""List of distinct items with O(log n) removal, index of an item and item
+at an index, for the cowboys and bullets whose indices programs see.
+
+Removed items leave a tombstone (`None`) in their slot, so the slots of the
+other items do not move. A Fenwick tree over the slots counts the items
+still present, which gives the index of an item (items present before its
+slot) and the item at an index (descending the tree). `compact` drops the
+tombstones, call it when the indices do not matter (between turns).
+"""
+from __future__ import annotations
+from typing import Generic, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+
+class RankedList(Generic[T]):
+    _items: list[T | None]  # by slot, None for removed items
+    _slots: dict[T, int]  # slot of each present item
+    _tree: list[int]  # Fenwick tree (1-based) of present items by slot
+
+    def __init__(self, items: Iterable[T] = ()) -> None:
+        self._items = list(items)
+        self._build()
+
+    def _build(self) -> None:
+        self._slots = {item: slot for slot, item in enumerate(self._items) if item is not None}
+        n = len(self._items)
+        tree = [0] * (n + 1)
+        for i in range(1, n + 1):
+            if self._items[i - 1] is not None:
+                tree[i] += 1
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _prefix(self, slots: int) -> int:
+        """Items present in the first `slots` slots."""
+        count = 0
+        tree = self._tree
+        while slots > 0:
+            count += tree[slots]
+            slots &= slots - 1
+        return count
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __iter__(self) -> Iterator[T]:
+        return (item for item in self._items if item is not None)
+
+    def __contains__(self, item: T) -> bool:
+        return item in self._slots
+
+    def __getitem__(self, index: int) -> T:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RankedList index out of range")
+        tree = self._tree
+        slot = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            if slot + step < len(tree) and tree[slot + step] <= index:
+                slot += step
+                index -= tree[slot]
+            step >>= 1
+        item = self._items[slot]
+        assert item is not None
+        return item
+
+    def append(self, item: T) -> None:
+        self._slots[item] = len(self._items)
+        self._items.append(item)
+        i = len(self._items)
+        self._tree.append(1 + self._prefix(i - 1) - self._prefix(i - (i & -i)))
+
+    def remove(self, item: T) -> None:
+        slot = self._slots.pop(item, None)
+        if slot is None:
+            raise ValueError("RankedList.remove(x): x not in list")
+        self._items[slot] = None
+        i = slot + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] -= 1
+            i += i & -i
+
+    def index(self, item: T) -> int:
+        slot = self._slots.get(item)
+        if slot is None:
+            raise ValueError("RankedList.index(x): x not in list")
+        return self._prefix(slot)
+
+    def compact(self) -> None:
+        """Drops the tombstones, the slots of items change."""
+        if len(self._slots) < len(self._items):
+            self._items = list(self)
+            self._build()
@@ -0,0 +1,44 @@
+"""Set of squares of the map (numbered `y * width + x`) with O(1) insertion,
+removal and uniformly random choice.
+
+Squares are kept in a list and every square knows its index in it, removal
+moves the last square of the list into the hole.
+"""
+from __future__ import annotations
+from random import randrange as rr
+from typing import Iterable
+
+
+class SquareSet:
+    squares: list[int]
+    positions: list[int]  # index in `squares` by square, -1 if not in the set
+
+    def __init__(self, cells: int, squares: Iterable[int] = ()) -> None:
+        self.squares = []
+        self.positions = [-1] * cells
+        for square in squares:
+            self.add(square)
+
+    def __len__(self) -> int:
+        return len(self.squares)
+
+    def __contains__(self, square: int) -> bool:
+        return self.positions[square] >= 0
+
+    def add(self, square: int) -> None:
+        if self.positions[square] < 0:
+            self.positions[square] = len(self.squares)
+            self.squares.append(square)
+
+    def discard(self, square: int) -> None:
+        position = self.positions[square]
+        if position < 0:
+            return
+        last = self.squares.pop()
+        if last != square:
+            self.squares[position] = last
+            self.positions[last] = position
+        self.positions[square] = -1
+
+    def choice(self) -> int:
+        return self.squares[rr(len(self.squares))]
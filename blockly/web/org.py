@@ -7,6 +7,7 @@ from wtforms import validators
 from simple_websocket import Server, ConnectionClosed  # type: ignore
 
 from blockly import game
+from blockly.profiler import totals_by_block
 
 app = Blueprint('org', __name__)
 
@@ -70,6 +71,7 @@ def statistics() -> str:
 class ActionForm(FlaskForm):
     calc_cowboys = wtforms.SubmitField('Kolo kovbojů')
     calc_bullets = wtforms.SubmitField('Kolo střel')
+    toggle_profiling = wtforms.SubmitField('Zapnout/vypnout profilování')
 
 
 class TimerForm(FlaskForm):
@@ -103,6 +105,10 @@ def control() -> Response | str:
                     G.map.simulate_bullets_turn()
                     flash("Kolo střel spočítáno", "success")
 
+                elif action_form.toggle_profiling.data:
+                    G.map.profiling = not G.map.profiling
+                    flash("Profilování zapnuto" if G.map.profiling else "Profilování vypnuto", "success")
+
             if timer_form.validate_on_submit():
                 if timer_form.start.data:
                     G.start_timer(
@@ -125,6 +131,9 @@ def control() -> Response | str:
     return render_template(
         'org_control.html',
         timer_running=G.timer is not None,
+        profiling=G.map.profiling,
+        cowboy_totals=totals_by_block(G.map.cowboy_profiles),
+        bullet_totals=totals_by_block(G.map.bullet_profiles),
         action_form=action_form,
         timer_form=timer_form,
     )
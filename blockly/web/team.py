@@ -145,6 +145,8 @@ def debug() -> str:
         'team_debug.html',
         cowboy_results=reversed(G.map.get_cowboy_results(team, 5)),
         bullet_results=reversed(G.map.get_bullet_results(team, 5)),
+        cowboy_profile=G.map.get_cowboy_profile(team),
+        bullet_profile=G.map.get_bullet_profile(team),
     )
 
 
@@ -169,7 +171,8 @@ def get_programs(entity: str) -> Response:
             "description": program.description,
             "last_modified": program.last_modified,
             "active": uuid == active,
-            "valid": program.program.valid()
+            "valid": program.program.valid(),
+            "step_bound": program.program.step_bound,
         })
 
     out.sort(key=lambda x: str(x['name']))
@@ -34,6 +34,7 @@ teams = [
 
 def stop_handler(sig, frame):
     blockly.game.G.stop_timer()
+    game_map.close()
     sys.exit(0)
 
 
@@ -57,7 +58,8 @@ game_map = GameMap(width=50, height=50, teams=teams,
                    gold_count=50,
                    wall_fraction=2, cluster_max=500,
                    load_saves=True,
-                   save_dir="save_large")
+                   save_dir="save_large",
+                   precompute_distances=True)
 
 blockly.game.G = blockly.game.Game(teams=teams, map=game_map, org_login="org", org_passwd="org")
 